@@ -0,0 +1,287 @@
+"""
+`benchmark.py`: Benchmarks slicers and tiffify on synthetic volumes.
+
+Run from the command line as
+python benchmark.py --output results.json
+and compare with an earlier run (e.g. from another commit) using
+python benchmark.py --output new.json --compare results.json
+
+A synthetic volume is generated (with a fixed seed) and saved in all
+supported formats in a temporary folder. For each format we measure open
+time, sequential and random slice latency, loadvol throughput and tiffify
+throughput for each factor, with and without blending. Startup is measured
+as the time of `tiffify --help` and the time until the first vis3d window is
+shown (using offscreen Qt platform), both in a fresh python process.
+
+Note that the volumes are small enough to stay in the OS file cache, so the
+measured times are mostly decoding and overhead, not disk reads.
+"""
+
+import argparse
+import contextlib
+import functools
+import http.server
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+import PIL.Image
+import tifffile
+import slicers
+import tiffify
+
+
+def make_volume(shape, seed=0):
+    ''' Smooth random uint16 volume, so that compression behaves as for
+    real data. '''
+    rng = np.random.default_rng(seed)
+    coarse = rng.random(tuple(max(s//8, 2) for s in shape))
+    vol = coarse
+    for axis, s in enumerate(shape):  # nearest upsampling, then noise
+        vol = np.repeat(vol, -(-s // vol.shape[axis]), axis=axis)
+    vol = vol[:shape[0], :shape[1], :shape[2]]
+    vol = vol + 0.1 * rng.random(shape)
+    return (vol / vol.max() * 65535).astype(np.uint16)
+
+
+def write_formats(vol, folder):
+    ''' Saves volume in all formats, returns dict with format names and
+    sources understood by slicers.slicer.'''
+
+    sources = {}
+
+    volfile = os.path.join(folder, 'volume.vol')
+    vol.tofile(volfile)
+    with open(volfile.replace('.vol', '.vgi'), 'w') as f:
+        f.write('{volume1}\n[file1]\n'
+                f'Size = {vol.shape[1]} {vol.shape[2]} {vol.shape[0]}\n'
+                'Datatype = unsigned integer\nBitsPerElement = 16\n'
+                'datarange = 0 65535\n{end}\n')
+    sources['vgi'] = volfile.replace('.vol', '.vgi')
+
+    tiffile = os.path.join(folder, 'volume.tif')
+    with tifffile.TiffWriter(tiffile) as writer:
+        for im in vol:
+            writer.write(im)
+    sources['tif'] = tiffile
+
+    tiffile = os.path.join(folder, 'volume_zlib.tif')
+    with tifffile.TiffWriter(tiffile) as writer:
+        for im in vol:
+            writer.write(im, compression='zlib', rowsperstrip=16)
+    sources['tif_zlib'] = tiffile
+
+    for name, ext in [('tif_folder', '.tif'), ('png_folder', '.png')]:
+        subfolder = os.path.join(folder, name)
+        os.mkdir(subfolder)
+        for z, im in enumerate(vol):
+            filename = os.path.join(subfolder, f'slice{z:05d}{ext}')
+            if ext == '.tif':
+                tifffile.imwrite(filename, im)
+            else:
+                PIL.Image.fromarray(im).save(filename)
+        sources[name] = subfolder
+
+    npyfile = os.path.join(folder, 'volume.npy')
+    np.save(npyfile, vol)
+    sources['npy'] = npyfile
+    return sources
+
+
+@contextlib.contextmanager
+def serving(folder):
+    ''' Serves folder over http on localhost, yields the base url.'''
+    handler = functools.partial(QuietHandler, directory=folder)
+    server = http.server.ThreadingHTTPServer(('localhost', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://localhost:{server.server_address[1]}'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def open_slicer(source):
+    return slicers.slicer(source)
+
+
+def bench_slicer(source, n_random, seed=0):
+    ''' Open time, slice latencies (median, in seconds) and loadvol
+    throughput (MB/s).'''
+
+    t = time.perf_counter()
+    slicer = open_slicer(source)
+    result = {'open': time.perf_counter() - t}
+
+    latencies = []
+    for z in range(len(slicer)):
+        t = time.perf_counter()
+        slicer[z]
+        latencies.append(time.perf_counter() - t)
+    result['sequential'] = float(np.median(latencies))
+
+    rng = np.random.default_rng(seed)
+    latencies = []
+    for z in rng.integers(0, len(slicer), n_random):
+        t = time.perf_counter()
+        slicer[int(z)]
+        latencies.append(time.perf_counter() - t)
+    result['random'] = float(np.median(latencies))
+
+    t = time.perf_counter()
+    vol = slicer.loadvol()
+    result['loadvol'] = vol.nbytes / 2**20 / (time.perf_counter() - t)
+    return result
+
+
+def bench_tiffify(source, folder, factors):
+    ''' Tiffify throughput in slices (of the source volume) per second.'''
+
+    result = {}
+    destination = os.path.join(folder, 'tiffified.tif')
+    report = os.path.join(folder, 'report.json')
+    for factor in factors:
+        for blend in [False, True]:
+            argv = ['tiffify', source, destination, '--factor', str(factor),
+                    '--overwrite', '--report', report]
+            if blend:
+                argv.append('--blend')
+            saved_argv, sys.argv = sys.argv, argv
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    tiffify.main()
+            finally:
+                sys.argv = saved_argv
+            with open(report) as f:
+                seconds = json.load(f)['seconds']
+            length = len(open_slicer(source))
+            mode = 'blend' if blend else 'plain'
+            result[f'tiffify_{mode}_{factor}'] = length / seconds
+    return result
+
+
+VIS3D_WINDOW = '''
+import sys, PyQt5.QtWidgets, slicers, vis3d
+app = PyQt5.QtWidgets.QApplication([])
+window = vis3d.Vis3d(slicers.slicer(sys.argv[1]))
+window.show()
+app.processEvents()
+'''
+
+
+def bench_startup(source, repeats=3):
+    ''' Median wall time (in seconds) of running tiffify --help and showing
+    the first vis3d window, in a new process.'''
+
+    folder = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, QT_QPA_PLATFORM='offscreen')
+    commands = {'tiffify_help': [os.path.join(folder, 'tiffify.py'), '--help'],
+                'vis3d_window': ['-c', VIS3D_WINDOW, source]}
+    result = {}
+    for name, command in commands.items():
+        times = []
+        for _ in range(repeats):
+            t = time.perf_counter()
+            process = subprocess.run([sys.executable] + command, cwd=folder,
+                                     env=env, capture_output=True)
+            times.append(time.perf_counter() - t)
+        if process.returncode == 0:  # e.g. vis3d fails without PyQt5
+            result[name] = float(np.median(times))
+    return result
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                    capture_output=True, text=True,
+                    cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return {'commit': commit or None,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'tifffile': tifffile.__version__,
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+def compare(results, previous):
+    ''' Prints ratio new/old for each measurement. For times, lower is
+    better, for throughputs (loadvol, tiffify), higher is better.'''
+
+    print(f'Comparing with commit {previous["environment"]["commit"]}')
+    sections = dict(results['formats'], startup=results['startup'])
+    previous = dict(previous['formats'], startup=previous.get('startup', {}))
+    for name, values in sections.items():
+        old = previous.get(name, {})
+        for key, value in values.items():
+            if old.get(key):
+                print(f'  {name:<12} {key:<20} {value / old[key]:6.2f}x')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark slicers and tiffify.')
+    parser.add_argument('--shape', type=int, nargs=3, default=[64, 256, 256])
+    parser.add_argument('--random', type=int, default=50)
+    parser.add_argument('--factors', type=int, nargs='+', default=[2, 4, 8])
+    parser.add_argument('--formats', nargs='+')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output')
+    parser.add_argument('--compare')
+    args = parser.parse_args()
+
+    results = {'environment': environment(),
+               'parameters': vars(args).copy(),
+               'formats': {},
+               'startup': {}}
+    with tempfile.TemporaryDirectory() as folder:
+        print('Writing synthetic volumes.')
+        vol = make_volume(tuple(args.shape), args.seed)
+        sources = write_formats(vol, folder)
+        with serving(folder) as url:
+            sources['url'] = url + '/volume.tif'
+            for name, source in sources.items():
+                if args.formats and name not in args.formats:
+                    continue
+                print(f'Benchmarking {name}.')
+                result = bench_slicer(source, args.random, args.seed)
+                result.update(bench_tiffify(source, folder, args.factors))
+                results['formats'][name] = result
+        print('Benchmarking startup.')
+        results['startup'] = bench_startup(sources['vgi'])
+
+    for name, values in results['formats'].items():
+        print(name)
+        for key, value in values.items():
+            if key in ('open', 'sequential', 'random'):
+                value, unit = 1000 * value, 'ms'
+            else:
+                unit = 'MB/s' if key == 'loadvol' else 'slices/s'
+            print(f'  {key:<20} {value:10.2f} {unit}')
+    print('startup')
+    for key, value in results['startup'].items():
+        print(f'  {key:<20} {1000 * value:10.2f} ms')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+
+    main()
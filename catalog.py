@@ -0,0 +1,217 @@
+"""
+`catalog.py`: Builds a catalog of volumes in a folder, with previews.
+
+Run from the command line as
+vis3d_catalog folder_with_volumes
+where the folder contains link files (like those in `links_gbar`) or volumes
+in any format supported by slicers. For each volume, the catalog contains
+metadata (size, dtype, range), intensity statistics from sampled slices, a
+thumbnail of the middle slice and orthogonal previews. These are saved in a
+subfolder `.vis3d_catalog`, and are only recomputed when the volume changes.
+Volumes are processed in parallel by a pool of worker processes.
+
+The file dialog of vis3d shows the previews when a cataloged file is chosen.
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import time
+
+CATALOG_FOLDER = '.vis3d_catalog'
+PREVIEW_SIZE = 256  # maximal size of previews in pixels
+STAT_SLICES = 16  # number of slices sampled for statistics
+
+
+def catalog_filename(path, suffix):
+    ''' Filename in the catalog of the folder containing path.'''
+    folder, name = os.path.split(os.path.abspath(path))
+    return os.path.join(folder, CATALOG_FOLDER, name + suffix)
+
+
+def resolve(path):
+    ''' Follows link files (.txt) to the source of the volume.'''
+    while path.endswith('.txt') and os.path.isfile(path):
+        with open(path) as f:
+            path = f.read().strip()
+    return path
+
+
+def signature(path):
+    ''' Changes when the volume or the link to it changes. For folders, the
+    modification time changes when files are added or removed.'''
+    items = []
+    for p in dict.fromkeys([path, resolve(path)]):
+        if p.startswith('http'):
+            items.append(p)
+        else:
+            stat = os.stat(p)
+            items.append([p, stat.st_mtime, stat.st_size])
+    if items[-1][0].endswith('.vgi'):  # data is in .vol file
+        stat = os.stat(items[-1][0].replace('.vgi', '.vol'))
+        items.append([stat.st_mtime, stat.st_size])
+    return items
+
+
+def find_volumes(folder):
+    ''' Files with extensions supported by slicers and folders with images.'''
+    import slicers
+    volumes = []
+    for name in sorted(os.listdir(folder)):
+        path = os.path.join(folder, name)
+        root, ext = os.path.splitext(name)
+        if name.startswith('.'):
+            continue
+        if os.path.isdir(path):
+            if slicers.list_imfiles(path, None):
+                volumes.append(path)
+        elif ext.lower() in slicers.formats:
+            if ext.lower() == '.vol' and os.path.exists(
+                    os.path.join(folder, root + '.vgi')):
+                continue  # same volume as the .vgi file
+            volumes.append(path)
+    return volumes
+
+
+def to_uint8(im, low, high):
+    im = (im.astype(float) - low) / max(high - low, 1e-12)
+    return (255 * im.clip(0, 1)).astype('uint8')
+
+
+def save_png(im, filename):
+    import PIL.Image
+    PIL.Image.fromarray(im).save(filename)
+
+
+def process(path):
+    ''' Computes catalog entry and previews for the volume at path.'''
+    import numpy as np
+    import slicers
+
+    t = time.perf_counter()
+    slicer = slicers.slicer(path)
+    Z, (H, W) = len(slicer), slicer.imshape
+    entry = {'source': resolve(path),
+             'slicer': type(slicer).__name__,
+             'shape': [Z, H, W],
+             'dtype': str(slicer.dtype),
+             'range': slicer.range}
+
+    # Statistics from strided subslices of evenly spaced slices
+    step = max(1, max(H, W) // (4 * PREVIEW_SIZE))
+    Y, X = range(0, H, step), range(0, W, step)
+    zs = np.unique(np.linspace(0, Z - 1, min(STAT_SLICES, Z)).astype(int))
+    sample = np.stack([slicer.subslice(int(z), Y, X) for z in zs]).astype(float)
+    p1, p99 = np.percentile(sample, [1, 99])
+    entry['stats'] = {'min': float(sample.min()), 'max': float(sample.max()),
+                      'mean': float(sample.mean()), 'std': float(sample.std()),
+                      'p1': float(p1), 'p99': float(p99),
+                      'sampled_slices': len(zs), 'sampled_step': step}
+
+    # Middle slice and orthogonal previews, scaled to 1-99 percentile
+    step = max(1, max(H, W) // PREVIEW_SIZE)
+    zstep = max(1, Z // PREVIEW_SIZE)
+    Y, X = range(0, H, step), range(0, W, step)
+    xy = slicer.subslice(Z // 2, Y, X)
+    xz, yz = [], []
+    for z in range(0, Z, zstep):  # middle row and column of each slice read
+        im = slicer.subslice(z, Y, X)
+        xz.append(im[len(Y) // 2])
+        yz.append(im[:, len(X) // 2])
+    xz, yz = np.stack(xz), np.stack(yz)
+    entry['previews'] = {}
+    for name, im in [('xy', xy), ('xz', xz), ('yz', yz)]:
+        filename = catalog_filename(path, f'_{name}.png')
+        save_png(to_uint8(im, p1, p99), filename)
+        entry['previews'][name] = os.path.basename(filename)
+    entry['seconds'] = time.perf_counter() - t
+    return entry
+
+
+def update_entry(path):
+    ''' Processes volume, unless the catalog entry is up to date. Returns
+    entry and whether it was recomputed. Errors are saved in the entry.'''
+    filename = catalog_filename(path, '.json')
+    try:
+        sig = signature(path)
+    except OSError as e:  # e.g. link to an unreachable file
+        entry = {'source': resolve(path), 'error': str(e)}  # with filename
+        sig = None  # never matches, so the volume is tried again next time
+    else:
+        if os.path.exists(filename):
+            with open(filename) as f:
+                entry = json.load(f)
+            if entry.get('signature') == json.loads(json.dumps(sig)):
+                return entry, False
+        try:
+            entry = process(path)
+        except Exception as e:
+            entry = {'source': resolve(path), 'error': repr(e)}
+    entry['signature'] = sig
+    with open(filename, 'w') as f:
+        json.dump(entry, f, indent=1)
+    return entry, True
+
+
+def cached_entry(path):
+    ''' Catalog entry for path if it exists, else None. Used by vis3d.'''
+    filename = catalog_filename(path, '.json')
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as f:
+        return json.load(f)
+
+
+def describe(entry):
+    if 'error' in entry:
+        return f'error: {entry["error"]}'
+    stats = entry['stats']
+    return (f'{entry["shape"][0]} x {tuple(entry["shape"][1:])}, '
+            f'{entry["dtype"]}, mean {stats["mean"]:.4g}, '
+            f'range [{stats["min"]:.4g}, {stats["max"]:.4g}]')
+
+
+def main():
+    """
+    Positional arguments:
+    - folder: The folder with volumes or link files.
+
+    Options taking values:
+    - workers: Number of worker processes, default is number of cpus.
+
+    Flags:
+    - force: If set, all volumes are recomputed.
+    """
+    parser = argparse.ArgumentParser(description='Catalog volumes in folder.')
+    parser.add_argument('folder')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--force', action='store_true', default=False)
+    args = parser.parse_args()
+
+    os.makedirs(os.path.join(args.folder, CATALOG_FOLDER), exist_ok=True)
+    volumes = find_volumes(args.folder)
+    if args.force:
+        for path in volumes:
+            if os.path.exists(catalog_filename(path, '.json')):
+                os.remove(catalog_filename(path, '.json'))
+    print(f'Cataloging {len(volumes)} volumes.')
+
+    catalog = {}
+    with concurrent.futures.ProcessPoolExecutor(args.workers) as executor:
+        futures = {executor.submit(update_entry, path): path for path in volumes}
+        for future in concurrent.futures.as_completed(futures):
+            path = futures[future]
+            entry, updated = future.result()
+            catalog[os.path.basename(path)] = entry
+            status = 'updated' if updated else 'cached'
+            print(f'{os.path.basename(path)} ({status}): {describe(entry)}')
+
+    with open(os.path.join(args.folder, CATALOG_FOLDER, 'catalog.json'), 'w') as f:
+        json.dump(dict(sorted(catalog.items())), f, indent=1)
+    print('Done!')
+
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,209 @@
+"""
+`checksum.py`: Per-slice hashes of volumes, and comparison of two volumes.
+
+Run from the command line as
+vis3d_checksum path_to_volume
+to hash each slice and save the hashes in a manifest next to the volume. When
+the manifest exists, slices are checked against it instead, and slices added
+since (e.g. to a folder) are hashed. Checking may be spread over several runs
+using `--max-slices`, which checks the slices checked longest ago.
+
+Run as
+vis3d_checksum path_to_volume path_to_other_volume
+to compare two volumes (e.g. a volume and its tiffify output at factor 1),
+reporting slices which differ, max abs error and PSNR.
+
+Volumes may be in any format supported by slicers. Slices are read by several
+threads, each reading from its own reopened slicer (slicers.ThreadReader), and
+only a few slices are in memory at a time. Hashes are of slice values in little-endian byte order, so
+they are equal for equal values and dtype, regardless of the format.
+"""
+
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+import sys
+import time
+
+HASH = 'blake2b-128'
+SAVE_INTERVAL = 60  # seconds between saving manifest while hashing
+
+
+def slice_hash(im):
+    ''' Hash of values of slice, independent of byte order.'''
+    import numpy as np
+    im = np.ascontiguousarray(im, dtype=im.dtype.newbyteorder('<'))
+    return hashlib.blake2b(im.data, digest_size=16).hexdigest()
+
+
+def parallel_map(function, zs, workers):
+    ''' Yields (z, function(z)) in order of zs, with at most 2*workers slices
+    being processed at a time.'''
+    zs = iter(zs)
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        futures = [(z, executor.submit(function, z))
+                   for _, z in zip(range(2 * workers), zs)]
+        while futures:
+            z, future = futures.pop(0)
+            result = future.result()
+            for z_next in zs:
+                futures.append((z_next, executor.submit(function, z_next)))
+                break
+            yield z, result
+
+
+def manifest_filename(path):
+    return os.path.abspath(path.rstrip('/\\')) + '.hashes.json'
+
+
+def load_manifest(filename):
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, filename):
+    ''' Saves via temporary file, such that an interrupted run leaves the
+    previous manifest.'''
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(filename + '.tmp', filename)
+
+
+def check(path, filename, workers, max_slices=None):
+    ''' Hashes slices missing from manifest, and checks the others against
+    it, the least recently checked first. Returns list of mismatching
+    slices.'''
+    import slicers
+    slicer = slicers.slicer(path)
+    shape = [len(slicer)] + list(slicer.imshape)
+    manifest = load_manifest(filename)
+    if manifest is not None and (manifest['shape'][1:] != shape[1:] or
+            manifest['dtype'] != str(slicer.dtype) or manifest['hash'] != HASH):
+        raise Exception(f'Manifest {filename} is for a volume of shape '
+                f'{manifest["shape"]} and dtype {manifest["dtype"]}, not '
+                f'{shape} and {slicer.dtype}.')
+    if manifest is None:
+        manifest = {'source': os.path.abspath(path), 'hash': HASH,
+                    'shape': shape, 'dtype': str(slicer.dtype),
+                    'slices': [], 'checked': []}
+    known = len(manifest['slices'])
+    if shape[0] < known:
+        raise Exception(f'Volume has {shape[0]} slices, manifest {filename} '
+                        f'has {known}.')
+    manifest['shape'] = shape
+    manifest['slices'] += [None] * (shape[0] - known)
+    manifest['checked'] += [None] * (shape[0] - known)
+
+    # Slices without hash first, then the least recently checked
+    zs = sorted(range(shape[0]), key=lambda z: (manifest['slices'][z] is not None,
+                                                manifest['checked'][z] or 0))
+    if max_slices is not None:
+        zs = zs[:max_slices]
+    readers = slicers.ThreadReader(slicer)
+    mismatches, hashed = [], 0
+    saved = time.time()
+    for z, h in parallel_map(lambda z: slice_hash(readers[z]), zs, workers):
+        if manifest['slices'][z] is None:
+            manifest['slices'][z] = h
+            hashed += 1
+        elif manifest['slices'][z] != h:
+            mismatches.append(z)
+            continue  # keeps the old hash and check time
+        manifest['checked'][z] = time.time()
+        if time.time() - saved > SAVE_INTERVAL:
+            save_manifest(manifest, filename)
+            saved = time.time()
+    save_manifest(manifest, filename)
+    print(f'Hashed {hashed} and checked {len(zs) - hashed} of {shape[0]} '
+          f'slices, manifest {filename}.')
+    return mismatches
+
+
+def compare(path, other_path, workers):
+    ''' Compares volumes slice by slice. Returns summary with slices which
+    differ, max abs error and PSNR.'''
+    import numpy as np
+    import slicers
+    slicer, other = slicers.slicer(path), slicers.slicer(other_path)
+    if len(slicer) != len(other) or slicer.imshape != other.imshape:
+        raise Exception(f'Volumes have different shapes, {len(slicer)} x '
+                        f'{slicer.imshape} and {len(other)} x {other.imshape}.')
+    readers = slicers.ThreadReader(slicer)
+    other_readers = slicers.ThreadReader(other)
+
+    def compare_slice(z):
+        a, b = readers[z], other_readers[z]
+        if a.dtype == b.dtype and slice_hash(a) == slice_hash(b):
+            return 0, 0, float(np.abs(a).max(initial=0))
+        d = a.astype(np.float64) - b.astype(np.float64)
+        return (float(np.abs(d).max(initial=0)), float((d * d).sum()),
+                float(np.abs(a).max(initial=0)))
+
+    differ, max_error, sse, peak = [], 0, 0, 0
+    for z, (error, slice_sse, slice_peak) in parallel_map(
+            compare_slice, range(len(slicer)), workers):
+        if error > 0:
+            differ.append(z)
+        max_error, sse, peak = max(max_error, error), sse + slice_sse, max(peak, slice_peak)
+    if np.issubdtype(slicer.dtype, np.integer):
+        peak = np.iinfo(slicer.dtype).max  # else max abs value of the volume
+    mse = sse / (len(slicer) * np.prod(slicer.imshape))
+    return {'slices': len(slicer), 'differing_slices': len(differ),
+            'first_differing_slice': differ[0] if differ else None,
+            'max_abs_error': max_error, 'mse': mse,
+            'psnr': float(10 * np.log10(peak**2 / mse)) if mse > 0 else float('inf')}
+
+
+def main():
+    """
+    Positional arguments:
+    - volume: The volume to hash, or to compare.
+    - other: If given, volume is compared to this volume.
+
+    Options taking values:
+    - manifest: Manifest filename when hashing, default is next to the
+      volume, with extension `.hashes.json`.
+    - workers: Number of threads reading slices, default is number of cpus,
+      at most 8.
+    - max_slices: Number of slices to check against the manifest, the least
+      recently checked first. Default is all.
+
+    Exits with status 1 if slices differ.
+    """
+    parser = argparse.ArgumentParser(description='Hash or compare volumes.')
+    parser.add_argument('volume')
+    parser.add_argument('other', nargs='?')
+    parser.add_argument('--manifest')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--max_slices', '--max-slices', type=int)
+    args = parser.parse_args()
+
+    import slicers
+    workers = args.workers or slicers.default_workers()
+    t = time.perf_counter()
+    if args.other is None:
+        filename = args.manifest or manifest_filename(args.volume)
+        mismatches = check(args.volume, filename, workers, args.max_slices)
+        if mismatches:
+            print(f'{len(mismatches)} slices do not match the manifest, the '
+                  f'first is slice {min(mismatches)}.')
+        else:
+            print('All checked slices match.')
+        failed = bool(mismatches)
+    else:
+        summary = compare(args.volume, args.other, workers)
+        for key, value in summary.items():
+            print(f'{key}: {value}')
+        failed = summary['differing_slices'] > 0
+    print(f'Done in {time.perf_counter() - t:.1f} s.')
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,210 @@
+'''
+Random access to gzip files using an index of seek points.
+
+While decompressing the whole file once, the state of the decompressor is
+recorded at deflate block boundaries every span bytes of output: the position
+in the compressed file (with bit offset) and the last 32 kB of output. Reading
+from an offset then decompresses only from the nearest preceding point. The
+index is saved next to the file (or in the temp folder, if that fails), and
+reused while the file is unchanged. This follows zran.c from the zlib
+examples, calling the system zlib through ctypes, since python's zlib module
+does not expose the needed functions (inflate with Z_BLOCK, inflatePrime).
+
+Only single-member gzip files are supported.
+'''
+
+import ctypes
+import ctypes.util
+import hashlib
+import os
+import tempfile
+import numpy as np
+
+WINSIZE = 32768  # deflate window size
+CHUNK = 2**18  # size of compressed chunks read from file
+
+Z_OK, Z_STREAM_END, Z_BUF_ERROR = 0, 1, -5
+Z_NO_FLUSH, Z_BLOCK = 0, 5
+
+
+class ZStream(ctypes.Structure):
+    _fields_ = [('next_in', ctypes.c_void_p),
+                ('avail_in', ctypes.c_uint),
+                ('total_in', ctypes.c_ulong),
+                ('next_out', ctypes.c_void_p),
+                ('avail_out', ctypes.c_uint),
+                ('total_out', ctypes.c_ulong),
+                ('msg', ctypes.c_char_p),
+                ('state', ctypes.c_void_p),
+                ('zalloc', ctypes.c_void_p),
+                ('zfree', ctypes.c_void_p),
+                ('opaque', ctypes.c_void_p),
+                ('data_type', ctypes.c_int),
+                ('adler', ctypes.c_ulong),
+                ('reserved', ctypes.c_ulong)]
+
+
+_zlib = None
+
+def libz():
+    ''' The system zlib, loaded on first use.'''
+    global _zlib
+    if _zlib is None:
+        name = ctypes.util.find_library('z') or ctypes.util.find_library('zlib1')
+        if name is None:
+            raise Exception('Random access to gzip files needs zlib library.')
+        _zlib = ctypes.CDLL(name)
+        _zlib.zlibVersion.restype = ctypes.c_char_p
+        _zlib.inflateInit2_.argtypes = [ctypes.POINTER(ZStream), ctypes.c_int,
+                                        ctypes.c_char_p, ctypes.c_int]
+        _zlib.inflate.argtypes = [ctypes.POINTER(ZStream), ctypes.c_int]
+        _zlib.inflateEnd.argtypes = [ctypes.POINTER(ZStream)]
+        _zlib.inflatePrime.argtypes = [ctypes.POINTER(ZStream), ctypes.c_int,
+                                       ctypes.c_int]
+        _zlib.inflateSetDictionary.argtypes = [ctypes.POINTER(ZStream),
+                                               ctypes.c_char_p, ctypes.c_uint]
+    return _zlib
+
+
+def inflate_init(window_bits):
+    ''' New inflate stream. Use 47 for gzip/zlib with header, -15 for raw.'''
+    zlib = libz()
+    stream = ZStream()
+    ret = zlib.inflateInit2_(ctypes.byref(stream), window_bits,
+                             zlib.zlibVersion(), ctypes.sizeof(ZStream))
+    if ret != Z_OK:
+        raise Exception(f'inflateInit failed with {ret}.')
+    return stream
+
+
+class GzipIndex:
+    ''' Index of seek points in gzip file, spaced by span bytes of
+    uncompressed data. Read data with read(offset, length).'''
+
+    def __init__(self, filename, span=2**22, index_filename=None):
+        self.filename = filename
+        self.span = span
+        stat = os.stat(filename)
+        self._source = np.array([stat.st_size, stat.st_mtime_ns, span])
+        if index_filename is None:
+            index_filename = filename + '.index.npz'
+        self.index_filename = index_filename
+        if not self.load():
+            self.build()
+            self.save()
+
+    def load(self):
+        ''' Loads saved index, returns whether it is valid for the file.'''
+        for index_filename in [self.index_filename, self._temp_filename()]:
+            try:
+                index = np.load(index_filename)
+            except (OSError, ValueError):
+                continue
+            if np.array_equal(index['source'], self._source):
+                self.points = index['points']  # out, in, bits
+                self.windows = np.split(index['windows'], index['ends'][:-1])
+                self.size = int(index['size'])
+                return True
+        return False
+
+    def save(self):
+        ends = np.cumsum([len(w) for w in self.windows])
+        index = dict(source=self._source, points=self.points, size=self.size,
+                     windows=np.concatenate(self.windows), ends=ends)
+        try:
+            np.savez_compressed(self.index_filename, **index)
+        except OSError:  # e.g. read-only data folder
+            np.savez_compressed(self._temp_filename(), **index)
+
+    def _temp_filename(self):
+        key = hashlib.md5(os.path.abspath(self.filename).encode()).hexdigest()
+        return os.path.join(tempfile.gettempdir(), f'gzindex_{key[:16]}.npz')
+
+    def build(self):
+        ''' Decompresses the whole file, recording points at block
+        boundaries.'''
+
+        zlib = libz()
+        stream = inflate_init(47)
+        window = ctypes.create_string_buffer(WINSIZE)
+        points, windows = [], []
+        totin = totout = last = 0
+        ret = Z_OK
+        try:
+            with open(self.filename, 'rb') as f:
+                while ret != Z_STREAM_END:
+                    data = f.read(CHUNK)
+                    if not data:
+                        raise Exception(f'{self.filename} is truncated.')
+                    inbuf = ctypes.create_string_buffer(data, len(data))
+                    stream.next_in = ctypes.addressof(inbuf)
+                    stream.avail_in = len(data)
+                    while stream.avail_in and ret != Z_STREAM_END:
+                        if stream.avail_out == 0:
+                            stream.next_out = ctypes.addressof(window)
+                            stream.avail_out = WINSIZE
+                        totin += stream.avail_in
+                        totout += stream.avail_out
+                        ret = zlib.inflate(ctypes.byref(stream), Z_BLOCK)
+                        totin -= stream.avail_in
+                        totout -= stream.avail_out
+                        if ret not in (Z_OK, Z_STREAM_END):
+                            raise Exception(f'Error {ret} decompressing '
+                                            f'{self.filename}.')
+                        # End of a block, which is not the last block
+                        if ((stream.data_type & 128) and not (stream.data_type & 64)
+                                and (totout == 0 or totout - last > self.span)):
+                            left = stream.avail_out
+                            last_out = window.raw[WINSIZE - left:] + window.raw[:WINSIZE - left]
+                            points.append((totout, totin, stream.data_type & 7))
+                            windows.append(np.frombuffer(last_out[-totout:]
+                                    if totout < WINSIZE else last_out, np.uint8))
+                            last = totout
+        finally:
+            zlib.inflateEnd(ctypes.byref(stream))
+        self.points = np.array(points, dtype=np.int64).reshape(-1, 3)
+        self.windows = windows
+        self.size = totout
+
+    def read(self, offset, length):
+        ''' Reads length bytes of uncompressed data from offset. Opens the
+        file for each read, so it is safe to use from several threads.'''
+
+        offset, length = int(offset), int(length)  # e.g. numpy integers
+        length = max(0, min(length, self.size - offset))
+        if length == 0:
+            return b''
+        p = np.searchsorted(self.points[:, 0], offset, side='right') - 1
+        out, pos, bits = (int(v) for v in self.points[p])
+        window = self.windows[p].tobytes()
+
+        zlib = libz()
+        stream = inflate_init(-15)  # raw deflate
+        outbuf = ctypes.create_string_buffer(offset - out + length)
+        stream.next_out = ctypes.addressof(outbuf)
+        stream.avail_out = len(outbuf)
+        try:
+            with open(self.filename, 'rb') as f:
+                f.seek(pos - (1 if bits else 0))
+                if bits:  # point is within a byte, prime with its high bits
+                    zlib.inflatePrime(ctypes.byref(stream), bits,
+                                      f.read(1)[0] >> (8 - bits))
+                if window:
+                    zlib.inflateSetDictionary(ctypes.byref(stream), window,
+                                              len(window))
+                while stream.avail_out:
+                    data = f.read(CHUNK)
+                    if not data:
+                        raise Exception(f'{self.filename} is truncated.')
+                    inbuf = ctypes.create_string_buffer(data, len(data))
+                    stream.next_in = ctypes.addressof(inbuf)
+                    stream.avail_in = len(data)
+                    ret = zlib.inflate(ctypes.byref(stream), Z_NO_FLUSH)
+                    if ret == Z_STREAM_END:
+                        break
+                    if ret != Z_OK:
+                        raise Exception(f'Error {ret} decompressing '
+                                        f'{self.filename}.')
+        finally:
+            zlib.inflateEnd(ctypes.byref(stream))
+        return outbuf.raw[offset - out:]
@@ -0,0 +1,194 @@
+'''
+Reslicing of volumes along oblique planes.
+
+ObliqueSlicer is a slicer, so it can be shown in vis3d, where slice index
+moves the plane along its normal. The plane is given by a center and a
+rotation, where the columns of the rotation matrix are the normal and the
+directions of image rows and columns, all in (z, y, x) voxel coordinates.
+Only slices in the z-slab crossed by the plane are read, and slices are
+kept in a brick cache, so nearby planes are resliced without reading. The
+cache grows to hold the slab, if needed.
+'''
+
+import collections
+import numpy as np
+import slicers
+
+
+class BrickCache:
+    ''' Least recently used cache of bricks (blocks of depth consecutive
+    slices) of a slicer, limited to max_bytes.'''
+
+    def __init__(self, slicer, depth=8, max_bytes=2**30):
+        self.slicer = slicer
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self._bricks = collections.OrderedDict()
+        self._nbytes = 0
+
+    def brick(self, b):
+        if b in self._bricks:
+            self._bricks.move_to_end(b)
+            return self._bricks[b]
+        z0 = b * self.depth
+        z1 = min(z0 + self.depth, len(self.slicer))
+        brick = np.stack([self.slicer[z] for z in range(z0, z1)])
+        self._bricks[b] = brick
+        self._nbytes += brick.nbytes
+        while self._nbytes > self.max_bytes and len(self._bricks) > 1:
+            _, old = self._bricks.popitem(last=False)
+            self._nbytes -= old.nbytes
+        return brick
+
+    def invalidate(self, z):
+        ''' Removes bricks containing slice z or later, e.g. when slices are
+        added to the volume.'''
+        for b in [b for b in self._bricks if (b + 1) * self.depth > z]:
+            self._nbytes -= self._bricks.pop(b).nbytes
+
+    def brick_nbytes(self):
+        return self.depth * int(np.prod(self.slicer.imshape)) * np.dtype(
+                self.slicer.dtype).itemsize
+
+
+def rotation(axis, angle):
+    ''' Rotation matrix for angle (in degrees) around axis 0, 1 or 2.'''
+    c, s = np.cos(np.radians(angle)), np.sin(np.radians(angle))
+    i, j = [a for a in range(3) if a != axis]
+    R = np.eye(3)
+    R[i, i], R[i, j], R[j, i], R[j, j] = c, -s, s, c
+    return R
+
+
+def plane_rotation(normal):
+    ''' Rotation with given normal (z, y, x) as first column. Rows and columns
+    directions are chosen as close as possible to y and x axes.'''
+    n = np.asarray(normal, dtype=float)
+    n = n / np.linalg.norm(n)
+    u = np.array([0, 1, 0]) if abs(n[1]) < 0.9 else np.array([1, 0, 0])
+    u = u - (u @ n) * n
+    u = u / np.linalg.norm(u)
+    return np.stack([n, u, np.cross(n, u)], axis=1)
+
+
+def bilinear(brick, zi, y0, y1, x0, x1, dy, dx):
+    ''' Bilinear interpolation in slices zi of brick.'''
+    _, H, W = brick.shape
+    flat = brick.ravel()
+    def at(yi, xi):
+        return flat[(zi * H + yi) * W + xi]
+
+    c0 = at(y0, x0) * (1 - dx) + at(y0, x1) * dx
+    c1 = at(y1, x0) * (1 - dx) + at(y1, x1) * dx
+    return c0 * (1 - dy) + c1 * dy
+
+
+def trilinear(cache, z, y, x, outside=0):
+    ''' Vectorized trilinear interpolation in the volume of a BrickCache at 
+    coordinates z, y, x (arrays of equal shape). Points are grouped by the 
+    brick containing floor(z), and each group is interpolated in its brick 
+    (and the first slice of the next brick), so bricks are not copied. 
+    Points outside the volume get value outside.'''
+
+    shape = (len(cache.slicer),) + tuple(cache.slicer.imshape)
+    inside = ((z >= 0) & (y >= 0) & (x >= 0) & (z <= shape[0] - 1)
+              & (y <= shape[1] - 1) & (x <= shape[2] - 1))
+    z, y, x = z[inside], y[inside], x[inside]
+    z0, y0, x0 = (np.floor(c).astype(np.intp) for c in (z, y, x))
+    dz, dy, dx = ((c - c0).astype(np.float32) for c, c0 in ((z, z0), (y, y0), (x, x0)))
+    z1 = np.minimum(z0 + 1, shape[0] - 1)
+    y1 = np.minimum(y0 + 1, shape[1] - 1)
+    x1 = np.minimum(x0 + 1, shape[2] - 1)
+
+    values = np.empty(len(z), dtype=np.float32)
+    bricks = z0 // cache.depth
+    order = np.argsort(bricks, kind='stable')
+    starts = np.flatnonzero(np.diff(bricks[order], prepend=-1))
+    for i, j in zip(starts, np.append(starts[1:], len(order))):
+        p = order[i:j]
+        b = int(bricks[p[0]])
+        brick = cache.brick(b)
+        zb0, zb1 = z0[p] - b * cache.depth, z1[p] - b * cache.depth
+        plane = lambda brick, zi, q: bilinear(brick, zi, y0[p[q]], y1[p[q]], 
+                                              x0[p[q]], x1[p[q]], dy[p[q]], dx[p[q]])
+        c0 = plane(brick, zb0, slice(None))
+        c1 = np.empty_like(c0)
+        here = zb1 < len(brick)  # else in the first slice of next brick
+        c1[here] = plane(brick, zb1[here], here)
+        if not here.all():
+            c1[~here] = plane(cache.brick(b + 1), zb1[~here] - len(brick), ~here)
+        values[p] = c0 * (1 - dz[p]) + c1 * dz[p]
+
+    out = np.full(inside.shape, outside, dtype=np.float32)
+    out[inside] = values
+    return out
+
+
+class ObliqueSlicer(slicers.Slicer):
+    ''' Slices a volume along planes given by center and rotation (or normal).
+    Slice k is the plane moved by k - len(self)//2 voxels along the normal.
+    Slices have the same shape as slices of the volume, and are float32.'''
+
+    def __init__(self, slicer, center=None, rotation=None, normal=None,
+                 max_bytes=2**30):
+
+        super().__init__()
+        self.filename = slicer.filename
+        self.slicer = slicer
+        self.cache = BrickCache(slicer, max_bytes=max_bytes)
+        self.max_bytes = max_bytes
+        self.dtype = np.dtype('float32')
+        self.imshape = tuple(slicer.imshape)
+        self.range = slicer.range
+        if center is None:  # such that default planes are volume slices
+            center = np.array((len(slicer),) + self.imshape) // 2
+        self.center = np.asarray(center, dtype=float)
+        if rotation is None:
+            rotation = np.eye(3) if normal is None else plane_rotation(normal)
+        self.rotation = np.asarray(rotation, dtype=float)
+
+    def __len__(self):
+        return len(self.slicer)
+
+    def __getitem__(self, k):
+        return self.reslice(self.center
+                            + (k - len(self)//2) * self.rotation[:, 0])
+
+    def _cache_state(self):
+        source = self.slicer._cache_state()
+        if source is None:
+            return None
+        return [type(self.slicer).__name__, source, self.center.tolist(), 
+                self.rotation.tolist()]
+
+    def refresh(self):
+        length = len(self.slicer)
+        added = self.slicer.refresh()
+        if added:
+            self.cache.invalidate(length)  # last brick may have been partial
+        return added
+
+    def rotate(self, axis, angle):
+        ''' Rotates plane around its own axis (0 is normal, 1 rows, 2 columns)
+        by angle in degrees.'''
+        self.rotation = self.rotation @ rotation(axis, angle)
+
+    def reslice(self, center):
+        ''' Interpolated image in the plane through center.'''
+        h, w = self.imshape
+        rows = np.arange(h) - h//2
+        cols = np.arange(w) - w//2
+        n, u, v = self.rotation.T
+        points = [center[i] + rows[:, None] * u[i] + cols[None, :] * v[i]
+                  for i in range(3)]
+
+        z = points[0]
+        z0 = max(int(np.floor(z.min())), 0)
+        z1 = min(int(np.ceil(z.max())) + 1, len(self.slicer))
+        if z0 >= z1:  # plane outside volume
+            return np.zeros(self.imshape, dtype=self.dtype)
+        # budget holds bricks crossed by the plane and the planes next to it
+        bricks = (z1 - 1) // self.cache.depth - z0 // self.cache.depth + 3
+        self.cache.max_bytes = max(self.max_bytes, 
+                                   bricks * self.cache.brick_nbytes())
+        return trilinear(self.cache, z, points[1], points[2])
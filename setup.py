@@ -16,7 +16,11 @@ setup(
     entry_points={
         'console_scripts': [
             'vis3d=vis3d:main',
-            'tiffify=tiffify:main'
+            'tiffify=tiffify:main',
+            'tiffify_merge=tiffify:merge',
+            'slice_server=slice_server:main',
+            'vis3d_catalog=catalog:main',
+            'vis3d_checksum=checksum:main'
         ]
     },
     install_requires = ['PyQt5', 'tifffile', 'Pillow', 
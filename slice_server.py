@@ -0,0 +1,128 @@
+"""
+`slice_server.py`: Serves slices of a volume over HTTP.
+
+Run next to the data (e.g. on a compute node) as
+slice_server path_to_volume --port 8000
+and view from another machine, through an ssh tunnel to port 8000, with
+vis3d http://localhost:8000
+
+The server has no authentication, so by default it only listens on
+localhost. Use `--host 0.0.0.0` to serve to other machines directly, only
+on a trusted network.
+
+Slices are sent zlib-compressed, optionally downsampled by a factor and
+cropped to a region of interest, so only the pixels needed for display cross
+the network instead of full-size pixmaps over X11.
+
+Endpoints:
+- /info returns a json with length, imshape, dtype and range of the volume.
+- /slice/<z>?factor=<f>&roi=<y0>,<y1>,<x0>,<x1> returns compressed slice
+  bytes, with shape and dtype given in X-Shape and X-Dtype headers.
+"""
+
+import argparse
+import http.server
+import json
+import threading
+import urllib.parse
+import zlib
+import slicers
+
+
+class SliceRequestHandler(http.server.BaseHTTPRequestHandler):
+    ''' Handles requests for volume info and slices. Server needs to have
+    attributes slicer and lock.'''
+
+    protocol_version = 'HTTP/1.1'  # keep-alive, avoids reconnecting per slice
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        try:
+            if parts == ['info']:
+                self.send_info()
+            elif len(parts) == 2 and parts[0] == 'slice':
+                query = urllib.parse.parse_qs(url.query)
+                self.send_slice(int(parts[1]), query)
+            else:
+                self.send_error(404, f'Unknown request {url.path}')
+        except (ValueError, IndexError) as e:
+            self.send_error(400, str(e))
+
+    def send_info(self):
+        slicer = self.server.slicer
+        with self.server.lock:
+            slicer.refresh()  # volume may grow, e.g. during reconstruction
+        info = {'length': len(slicer),
+                'imshape': list(slicer.imshape),
+                'dtype': str(slicer.dtype),
+                'range': slicer.range,
+                'filename': str(slicer.filename)}
+        self.send_bytes(json.dumps(info).encode(), 'application/json')
+
+    def send_slice(self, z, query):
+        slicer = self.server.slicer
+        if not 0 <= z < len(slicer):
+            raise IndexError(f'Slice {z} outside volume of length {len(slicer)}')
+        factor = int(query.get('factor', ['1'])[0])
+        if 'roi' in query:
+            y0, y1, x0, x1 = (int(c) for c in query['roi'][0].split(','))
+        else:
+            y0, y1, x0, x1 = 0, slicer.imshape[0], 0, slicer.imshape[1]
+        Y = range(y0, y1, factor)
+        X = range(x0, x1, factor)
+        with self.server.lock:  # slicers keep open streams, not thread-safe
+            im = slicer.subslice(z, Y, X)
+        headers = {'X-Shape': f'{im.shape[0]},{im.shape[1]}',
+                   'X-Dtype': str(im.dtype)}
+        data = zlib.compress(im.tobytes(), self.server.level)
+        self.send_bytes(data, 'application/octet-stream', headers)
+
+    def send_bytes(self, data, content_type, headers={}):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass  # silent, as requests come for every slice change
+
+
+def make_server(source, host='localhost', port=8000, level=1):
+    ''' Returns a server for source, which may be anything accepted by
+    slicers.slicer or a slicer. Use port 0 for any free port.'''
+
+    if not isinstance(source, slicers.Slicer):
+        source = slicers.slicer(source)
+    server = http.server.ThreadingHTTPServer((host, port), SliceRequestHandler)
+    server.slicer = source
+    server.lock = threading.Lock()
+    server.level = level  # zlib compression level, 1 is fast
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve volume slices over http.')
+    parser.add_argument('source')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--level', type=int, default=1)
+    args = parser.parse_args()
+
+    print('Opening source volume.')
+    server = make_server(args.source, args.host, args.port, args.level)
+    host, port = server.server_address[:2]
+    print(f'Serving {server.slicer.filename} on http://{host}:{port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('Done!')
+    server.server_close()
+
+
+if __name__ == '__main__':
+
+    main()
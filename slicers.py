@@ -8,38 +8,187 @@ Author: Vedrana Dahl, 2022
 '''
 
 import numpy as np
-import configparser  # for easy reading of .vgi file
-import compoundfiles  # for reading .txm files
 import struct  # for conversion from bytes to values
-import PIL.Image
-import urllib.request
-import tifffile
+import json
+import zlib
 import os
+import io
+import time
+import hashlib
+import tempfile
+import concurrent.futures
+import collections
+import contextlib
+import heapq
+import threading
+
+# Libraries for reading specific formats (tifffile, PIL, compoundfiles, ...)
+# are imported in the slicers using them. This way, only the library needed 
+# for the chosen format is imported, which makes startup faster.
 
 class Slicer:
     ''' Base class for volume slicers.'''
 
+    partial_reads = False  # whether subslice reads only the needed rows
+    strided_reads = False  # also for strided rows, as in previews
+
     def __init__(self):
         self.dtype = None
         self.imshape = None
         self.range = None
         self.filename = ''
+        self.timings = None  # set to Timings() to record read times
     
     def __len__(self):
         return 0
 
-    def loadvol(self, verbose=False):
+    def loadvol(self, verbose=False, max_memory=None, scratch=None, 
+                keep=False, workers=None):
         ''' Default loads slice by slice. For most slicers, it would be more 
         efficient to implement a custom loader which utilizes the ordering of 
-        slices'''
+        slices. 
         
-        vol = np.empty((len(self),) + self.imshape, dtype=self.dtype)
-        for z in range(len(self)):
+        If the volume is larger than max_memory (in bytes), it is loaded to 
+        a np.memmap backed by a .npy file in scratch folder (default is system 
+        temp folder). With keep, the file is kept and reused by later calls 
+        for the same volume, identified by its class, files (with times and 
+        sizes) and settings. Changes to the returned array are not written 
+        to the file. Without keep, the file is removed once mapped (on 
+        systems which allow it). 
+        Slices are read in parallel chunks by workers threads, if the slicer 
+        can be reopened.'''
+
+        shape = (len(self),) + tuple(self.imshape)
+        if max_memory is None or self.nbytes() <= max_memory:
+            vol = np.empty(shape, dtype=self.dtype)
+            self._fill(vol, verbose, workers)
+            return vol
+
+        scratch = scratch or tempfile.gettempdir()
+        key = self._cache_key() if keep else None
+        if keep and key is None:
+            raise Exception(f'Can not keep the loaded volume, as '
+                    f'{type(self).__name__} does not read it from files.')
+        filename = os.path.join(scratch, f'loadvol_{key}.npy')
+        if keep and os.path.exists(filename):
             if verbose:
-                print(f'slice {z}/{len(self)}')
-            vol[z] = self[z]
-        return vol
+                print(f'Reusing {filename}')
+            return np.load(filename, mmap_mode='c')  # changes stay in memory
+
+        # unique name, such that concurrent calls don't share the file
+        fd, partial = tempfile.mkstemp(dir=scratch, suffix='.npy',
+                prefix=f'loadvol_{key}_' if keep else 'loadvol_')
+        os.close(fd)
+        vol = np.lib.format.open_memmap(partial, mode='w+', dtype=self.dtype, 
+                                        shape=shape)
+        self._fill(vol, verbose, workers)
+        vol.flush()
+        if not keep:
+            try:
+                os.remove(partial)  # mapping stays valid on posix
+            except OSError:
+                pass
+            return vol
+        del vol
+        os.replace(partial, filename)  # only complete files are reused
+        return np.load(filename, mmap_mode='c')
+
+    def _fill(self, vol, verbose=False, workers=None):
+        ''' Fills vol with slices, using contiguous chunks of slices for each
+        worker.'''
+
+        if workers is None:
+            workers = default_workers()
+        readers = [self]
+        for _ in range(1, min(workers, len(self))):
+            other = self.reopen()
+            if other is None:
+                break
+            readers.append(other)
+
+        def fill_chunk(slicer, chunk):
+            for z in chunk:
+                if verbose:
+                    print(f'slice {z}/{len(self)}')
+                vol[z] = slicer[z]
+
+        chunks = np.array_split(np.arange(len(self)), len(readers))
+        if len(readers) == 1:
+            fill_chunk(self, chunks[0])
+            return
+        with concurrent.futures.ThreadPoolExecutor(len(readers)) as executor:
+            for future in [executor.submit(fill_chunk, slicer, chunk) 
+                           for slicer, chunk in zip(readers, chunks)]:
+                future.result()  # raises exceptions from workers
+
+    def nbytes(self):
+        return len(self) * int(np.prod(self.imshape)) * np.dtype(self.dtype).itemsize
+
+    def reopen(self):
+        ''' Returns a slicer for the same volume which can be used from another
+        thread, or None if not possible. Slicers which are safe to use from 
+        more threads return themselves.'''
+        return None
+
+    def refresh(self):
+        ''' Checks for slices added since opening, e.g. while a scan is being
+        reconstructed, and extends the volume. Returns the number of added 
+        slices. Slicers for volumes of fixed size return 0.'''
+        return 0
+
+    def _cache_key(self):
+        ''' Identifies volume, for reusing files written by loadvol. None 
+        if the volume is not read from files, e.g. for numpy arrays.'''
+        state = self._cache_state()
+        if state is None:
+            return None
+        key = repr((type(self).__name__, len(self), tuple(self.imshape), 
+                    str(self.dtype), state))
+        return hashlib.md5(key.encode()).hexdigest()[:16]
+
+    def _cache_state(self):
+        ''' Paths, modification times and sizes of the files read by the 
+        slicer, or None if it reads something else. Slicers with more state 
+        than their files should extend this.'''
+        files = self._cache_files()
+        try:
+            stats = [os.stat(f) for f in files]
+        except (OSError, TypeError, ValueError):
+            return None
+        return [(os.path.abspath(f), st.st_mtime_ns, st.st_size) 
+                for f, st in zip(files, stats)] or None
+
+    def _cache_files(self):
+        return [self.filename] if self.filename else []
+
+    def subslice(self, z, Y, X):
+        ''' Returns rows Y and columns X of slice z. Default reads the full 
+        slice and subindexes it. Slicers which can read only a part of the 
+        slice should override this.'''
+
+        return self[z][subindexing(Y, X)]
         
+    def enable_timings(self):
+        ''' Starts recording per-call read and decode times and bytes read.'''
+        self.timings = Timings()
+        return self.timings
+
+    def _timed(self, call, z, read, decode=None):
+        ''' Returns decode(read()), recording times if timings enabled. 
+        Formats where reading and decoding can't be separated only give read.'''
+
+        if self.timings is None:
+            raw = read()
+            return raw if decode is None else decode(raw)
+        t0 = time.perf_counter()
+        raw = read()
+        t1 = time.perf_counter()
+        im = raw if decode is None else decode(raw)
+        t2 = time.perf_counter()
+        self.timings.add(call, z, read=t1 - t0, decode=t2 - t1, 
+                         nbytes=count_bytes(raw))
+        return im
+
     def to_uint8(self):
         ''' Returns a suitable function which casts slicer output to uint8.
         TODO: include other relevant options.'''
@@ -60,7 +209,7 @@ class Slicer:
             return Slicer.slicewise
         
     def to_range(self, im):
-        im -= self.range[0]
+        im = im - self.range[0]  # not in-place, slices may be read-only views
         im *= 1/(self.range[1] - self.range[0])
         return (255*im).astype('uint8')
 
@@ -74,16 +223,20 @@ class Slicer:
 
     @staticmethod
     def slicewise(im):
-        im -= im.min()
-        im *= 1/im.max()
-        return (255*im).astype('uint8')
+        im = im - im.min()  # not in-place, slices may be read-only views
+        return (255/im.max() * im).astype('uint8')
 
 
 class VgiSlicer(Slicer):
     '''Reads slices from .vol and an associated .vgi file.'''
     
+    partial_reads = True
+    strided_reads = True
+
     def __init__(self, filename):
 
+        import configparser  # for easy reading of .vgi file
+
         super().__init__()        
         self.filename = filename
         parser = configparser.ConfigParser()
@@ -111,17 +264,36 @@ class VgiSlicer(Slicer):
         self.imshape = (volsize[0], volsize[1])
         volfilename = filename.replace('.vgi', '.vol')
         self._stream = open(volfilename)  # speedup if stream kept open
+        self._volfilename = volfilename
+        self._memmap = None  # created on first subslice
 
     def __del__(self):
         self._stream.close()
 
+    def _cache_files(self):
+        return [self.filename, self._volfilename]
+
     def __len__(self):
         return self._length
 
     def __getitem__(self, z):
-        self._stream.seek(self._imlength * z * self.dtype.itemsize)
-        im = np.fromfile(self._stream, dtype=self.dtype, count=self._imlength)
-        return im.reshape(self.imshape)
+        def read():
+            self._stream.seek(self._imlength * z * self.dtype.itemsize)
+            return np.fromfile(self._stream, dtype=self.dtype, 
+                               count=self._imlength)
+        return self._timed('getitem', z, read, 
+                           lambda im: im.reshape(self.imshape))
+
+    def subslice(self, z, Y, X):
+        ''' Uses memmap view, so only the pages containing rows Y are read.'''
+        if self._memmap is None:
+            self._memmap = np.memmap(self._volfilename, dtype=self.dtype, 
+                    mode='r', shape=(self._length,) + self.imshape)
+        return self._timed('subslice', z, 
+                lambda: np.array(self._memmap[z][subindexing(Y, X)]))
+
+    def reopen(self):
+        return VgiSlicer(self.filename)
 
 
 class TxmSlicer(Slicer):
@@ -129,6 +301,8 @@ class TxmSlicer(Slicer):
     
     def __init__(self, filename):
 
+        import compoundfiles  # for reading .txm files
+
         super().__init__()   
         self.filename = filename
         self._data = compoundfiles.CompoundFileReader(filename)
@@ -159,61 +333,148 @@ class TxmSlicer(Slicer):
     def __len__(self):
         return len(self._keys)
 
+    def reopen(self):
+        return TxmSlicer(self.filename)
+
     def __getitem__(self, z):
         key = self._keys[z]
-        im = np.frombuffer(self._data.open(key).read(), 
-                           dtype=self.dtype)
-        return im.reshape(self.imshape)
+        return self._timed('getitem', z, lambda: self._data.open(key).read(), 
+                lambda b: np.frombuffer(b, dtype=self.dtype).reshape(self.imshape))
+
 
+class ImageFolderSlicer(Slicer):
+    '''Base for slicers reading a folder with one image file per slice. Files
+    added to the folder (e.g. during a scan) are appended by refresh, which
+    lists the folder only if its modification time changed. New files are 
+    expected to sort after the existing ones, and are used once they have not
+    been modified for settle seconds.'''
 
-class TiffFolderSlicer(Slicer):
+    settle = 1
 
-    def __init__(self, foldername):
+    def __init__(self, foldername, ext):
 
         super().__init__()   
         self.filename = foldername
-        self._filenames = list_imfiles(foldername, ['.tif', '.tiff'])
+        self._filenames = list_imfiles(foldername, ext)
+        if not self._filenames:
+            raise Exception(f'No images in {foldername}.')
+        self._ext = ext or [os.path.splitext(self._filenames[0])[-1].lower()]
+        self._pending = set()  # new files, not yet settled
+        self._mtime = self._folder_mtime()
+
+    def __len__(self):
+        return len(self._filenames)
+
+    def reopen(self):
+        return self  # each slice is read from its own file
+
+    def _cache_files(self):
+        return self._filenames
+
+    def _folder_mtime(self):
+        mtime = os.stat(self.filename).st_mtime
+        # With coarse timestamps, files may be added without changing mtime
+        return None if time.time() - mtime < self.settle else mtime
+
+    def refresh(self):
+        mtime = self._folder_mtime()
+        if mtime is not None and mtime == self._mtime and not self._pending:
+            return 0
+        if mtime is None or mtime != self._mtime:
+            self._mtime = mtime
+            last = os.path.basename(self._filenames[-1])
+            self._pending.update(name for name in os.listdir(self.filename)
+                    if name > last and os.path.splitext(name)[-1].lower() in self._ext)
+        added, removed = [], []
+        now = time.time()
+        for name in sorted(self._pending):  # keeping the order of slices
+            try:
+                if now - os.path.getmtime(os.path.join(self.filename, name)) < self.settle:
+                    break
+            except OSError:  # removed again
+                removed.append(name)
+            else:
+                added.append(name)
+        self._pending.difference_update(added + removed)
+        self._filenames.extend(os.path.join(self.filename, name) for name in added)
+        return len(added)
+
+
+class TiffFolderSlicer(ImageFolderSlicer):
+
+    def __init__(self, foldername, workers=None):
+        import tifffile
+
+        super().__init__(foldername, ['.tif', '.tiff'])
+        self.workers = workers or default_workers()  # threads decoding a slice
         im0 = tifffile.TiffFile(self._filenames[0])
         self.dtype = im0.pages[0].dtype
         self.imshape = im0.pages[0].shape
+        self.partial_reads = has_partial_reads(im0.pages[0])
+        self.strided_reads = is_raw_contiguous(im0.pages[0])
         im0.close()
 
-    def __len__(self):
-        return len(self._filenames)
-
     def __getitem__(self, z):
-        return tifffile.imread(self._filenames[z])
+        import tifffile
+        if self.timings is None:
+            return tifffile.imread(self._filenames[z], maxworkers=self.workers)
+        return self._timed('getitem', z, lambda: read_bytes(self._filenames[z]),
+                lambda b: tifffile.imread(io.BytesIO(b), maxworkers=self.workers))
+
+    def subslice(self, z, Y, X):
+        import tifffile
+        def read():
+            with tifffile.TiffFile(self._filenames[z]) as tif:
+                return read_tiff_rows(tif.pages[0], Y, X, self.workers)
+        return self._timed('subslice', z, read)
+
+    def _fill(self, vol, verbose=False, workers=None):
+        ''' Decodes files in parallel, one thread per file.'''
+        import tifffile
+
+        def fill_slice(z):
+            vol[z] = tifffile.imread(self._filenames[z], maxworkers=1)
+
+        with concurrent.futures.ThreadPoolExecutor(workers or self.workers) as executor:
+            for z, _ in enumerate(executor.map(fill_slice, range(len(self)))):
+                if verbose:
+                    print(f'slice {z}/{len(self)}')
 
 
-class FolderSlicer(Slicer):
+class FolderSlicer(ImageFolderSlicer):
 
     def __init__(self, foldername, ext=['.tif', '.tiff']):
+        import PIL.Image
 
-        super().__init__()   
-        self.filename = foldername
-        self._filenames = list_imfiles(foldername, ext)
+        super().__init__(foldername, ext)
         im0 = PIL.Image.open(self._filenames[0])
         self.dtype = PIL_mode_to_np_dtype(im0.mode)
-        self.imshape = im0.size
+        self.imshape = im0.size[::-1]  # PIL size is (width, height)
         im0.close()
-        
-    def __len__(self):
-        return len(self._filenames)
 
     def __getitem__(self, z):
-        return np.array(PIL.Image.open(self._filenames[z]))
+        import PIL.Image
+        if self.timings is None:
+            return np.array(PIL.Image.open(self._filenames[z]))
+        return self._timed('getitem', z, lambda: read_bytes(self._filenames[z]),
+                           lambda b: np.array(PIL.Image.open(io.BytesIO(b))))
 
 
 class TiffFileSlicer(Slicer):
-    
-    def __init__(self, filename):
+
+    def __init__(self, filename, workers=None):
+        import tifffile
 
         super().__init__()   
         self.filename = filename
+        self.workers = workers or default_workers()  # threads decoding a slice
         self._tiffFile = tifffile.TiffFile(filename)
         self._len = len(self._tiffFile.pages)
         self.dtype = self._tiffFile.pages[0].dtype
         self.imshape = self._tiffFile.pages[0].shape
+        self.partial_reads = has_partial_reads(self._tiffFile.pages[0])
+        # strips and tiles span several rows, so strided rows read them all
+        self.strided_reads = is_raw_contiguous(self._tiffFile.pages[0])
 
     def __del__(self):
         self._tiffFile.close()
@@ -221,19 +482,59 @@ class TiffFileSlicer(Slicer):
     def __len__(self):
         return self._len
 
+    def reopen(self):
+        return TiffFileSlicer(self.filename, self.workers)
+
     def __getitem__(self, z):
-        return self._tiffFile.pages[z].asarray()
+        page = self._tiffFile.pages[z]
+        if self.timings is None or not is_stripped(page):
+            return self._timed('getitem', z, 
+                               lambda: page.asarray(maxworkers=self.workers))
+        return self._timed('getitem', z, lambda: read_tiff_strips(page), 
+                lambda strips: decode_tiff_strips(page, strips, self.workers))
+
+    def subslice(self, z, Y, X):
+        return self._timed('subslice', z, 
+                lambda: read_tiff_rows(self._tiffFile.pages[z], Y, X, self.workers))
+
+    def _fill(self, vol, verbose=False, workers=None):
+        ''' Reads strips sequentially and decodes pages in parallel, one 
+        thread per page. At most two pages per thread are read ahead. 
+        Uncompressed and tiled pages, or a single worker, use the default
+        loader.'''
+
+        workers = workers or self.workers
+        page = self._tiffFile.pages[0]
+        if workers == 1 or not is_stripped(page) or page.compression == 1:
+            return super()._fill(vol, verbose, workers)
+
+        def fill_slice(z, page, strips):
+            vol[z] = decode_tiff_strips(page, strips)
+
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            pending = collections.deque()
+            for z in range(len(self)):
+                if verbose:
+                    print(f'slice {z}/{len(self)}')
+                page = self._tiffFile.pages[z]
+                pending.append(executor.submit(fill_slice, z, page, 
+                                               read_tiff_strips(page)))
+                while len(pending) > 2 * workers:
+                    pending.popleft().result()
+            for future in pending:
+                future.result()  # raises exceptions from workers
 
 
 class FileSlicer(Slicer):
     
     def __init__(self, filename):
+        import PIL.Image
 
         super().__init__()   
         self.filename = filename
         self._volfile = PIL.Image.open(filename)
         self.dtype = PIL_mode_to_np_dtype(self._volfile.mode)
-        self.imshape = self._volfile.size
+        self.imshape = self._volfile.size[::-1]  # PIL size is (width, height)
         
     def __del__(self):
         self._volfile.close()
@@ -242,20 +543,218 @@ class FileSlicer(Slicer):
         return self._volfile.n_frames
 
     def __getitem__(self, z):
-        self._volfile.seek(z)
-        return np.array(self._volfile)
+        def read():
+            self._volfile.seek(z)
+            return np.array(self._volfile)
+        return self._timed('getitem', z, read)
 
     @classmethod
     def from_url(cls, url):
+        import urllib.request
         slicer = cls(urllib.request.urlopen(url))
         slicer.filename = url
         return slicer
     
 
 
+class RemoteSlicer(Slicer):
+    '''Reads slices from a slice server, see slice_server.py. Slices may be 
+    downsampled by factor and cropped to roi (y0, y1, x0, x1) on the server.'''
+
+    partial_reads = True
+    strided_reads = True  # only the needed rows are sent
+
+    def __init__(self, url, factor=1, roi=None):
+        import urllib.parse
+        import http.client  # keeps connection open
+
+        super().__init__()
+        self.filename = url
+        parsed = urllib.parse.urlparse(url)
+        self._connection = http.client.HTTPConnection(parsed.hostname, 
+                                                      parsed.port)
+        self._path = parsed.path.rstrip('/')
+        info = json.loads(self._get('/info')[0])
+        self._length = info['length']
+        self.dtype = np.dtype(info['dtype'])
+        self.range = info['range']
+        if roi is None:
+            roi = (0, info['imshape'][0], 0, info['imshape'][1])
+        self._factor = factor
+        self._roi = roi
+        self.imshape = (len(range(roi[0], roi[1], factor)), 
+                        len(range(roi[2], roi[3], factor)))
+
+    def __del__(self):
+        self._connection.close()
+
+    def reopen(self):
+        return RemoteSlicer(self.filename, self._factor, self._roi)
+
+    def __len__(self):
+        return self._length
+
+    def refresh(self):
+        ''' Asks the server for the current length of the volume.'''
+        length = json.loads(self._get('/info')[0])['length']
+        added, self._length = length - self._length, length
+        return added
+
+    def __getitem__(self, z):
+        return self._get_slice(z, self._factor, self._roi)
+
+    def subslice(self, z, Y, X):
+        ''' Strided reads are done on the server, if possible.'''
+        if (self._factor == 1 and isinstance(Y, range) and isinstance(X, range)
+                and Y.step == X.step):
+            roi = (self._roi[0] + Y.start, self._roi[0] + Y.stop,
+                   self._roi[2] + X.start, self._roi[2] + X.stop)
+            return self._get_slice(z, Y.step, roi)
+        return super().subslice(z, Y, X)
+
+    def _get_slice(self, z, factor, roi):
+        import urllib.parse
+        query = urllib.parse.urlencode({'factor': factor, 
+                                        'roi': ','.join(str(r) for r in roi)})
+
+        def decode(response):
+            data, headers = response
+            shape = tuple(int(n) for n in headers['X-Shape'].split(','))
+            # bytearray makes the slice writable, as expected by to_uint8
+            im = np.frombuffer(bytearray(zlib.decompress(data)), 
+                               dtype=headers['X-Dtype'])
+            return im.reshape(shape)
+
+        return self._timed('getitem', z, 
+                           lambda: self._get(f'/slice/{z}?{query}'), decode)
+
+    def _get(self, path):
+        self._connection.request('GET', self._path + path)
+        response = self._connection.getresponse()
+        data = response.read()
+        if response.status != 200:
+            raise Exception(f"Slice server error {response.status} for {path}.")
+        return data, response.headers
+
+
+class CompositeSlicer(Slicer):
+    '''Combines slicers into one volume without copying. Each part is placed
+    at offset (z, y, x), and parts without z offset follow the previous part 
+    along z. Where parts overlap, later parts are shown, and voxels not covered
+    by any part have value fill.
+
+    Usually made from a .stitch file, a json file such as
+    {"parts": [{"source": "top.vgi"}, 
+               {"source": "bottom_folder", "z": 980, "y": 12, "x": 0}], 
+     "fill": 0}
+    where sources may be anything accepted by slicer, relative to the file.'''
+
+    def __init__(self, parts, offsets=None, fill=0):
+
+        super().__init__()
+        self._parts = list(parts)
+        if offsets is None:
+            offsets = [None] * len(self._parts)
+        self._offsets = []
+        end = 0
+        for part, offset in zip(self._parts, offsets):
+            z, y, x = offset if offset is not None else (None, 0, 0)
+            z = end if z is None else z
+            if min(z, y, x) < 0:
+                raise Exception(f'Negative offset {(z, y, x)} of {part.filename}.')
+            self._offsets.append((z, y, x))
+            end = z + len(part)
+        self._length = max(o[0] + len(p) for o, p in zip(self._offsets, self._parts))
+        self.imshape = (max(o[1] + p.imshape[0] for o, p in zip(self._offsets, self._parts)),
+                        max(o[2] + p.imshape[1] for o, p in zip(self._offsets, self._parts)))
+        self.dtype = np.result_type(*[p.dtype for p in self._parts])
+        ranges = [p.range for p in self._parts if p.range is not None]
+        if ranges:
+            self.range = [min(r[0] for r in ranges), max(r[1] for r in ranges)]
+        self.partial_reads = all(p.partial_reads for p in self._parts)
+        self.strided_reads = all(p.strided_reads for p in self._parts)
+        self.fill = fill
+
+    @classmethod
+    def from_file(cls, filename):
+        with open(filename) as f:
+            manifest = json.load(f)
+        folder = os.path.dirname(os.path.abspath(filename))
+        parts, offsets = [], []
+        for entry in manifest['parts']:
+            source = entry['source']
+            if not source.startswith('http'):
+                source = os.path.join(folder, source)
+            parts.append(slicer(source))
+            offsets.append((entry.get('z'), entry.get('y', 0), entry.get('x', 0)))
+        composite = cls(parts, offsets, manifest.get('fill', 0))
+        composite.filename = filename
+        return composite
+
+    def __len__(self):
+        return self._length
+
+    def reopen(self):
+        parts = [p.reopen() for p in self._parts]
+        if any(p is None for p in parts):
+            return None
+        composite = CompositeSlicer(parts, self._offsets, self.fill)
+        composite.filename = self.filename
+        return composite
+
+    def _cache_state(self):
+        parts = [p._cache_state() for p in self._parts]
+        if any(p is None for p in parts):
+            return None
+        return [parts, self._offsets, self.fill]
+
+    def _covering(self, z):
+        ''' Parts containing slice z, with their offsets.'''
+        return [(p, o) for p, o in zip(self._parts, self._offsets) 
+                if o[0] <= z < o[0] + len(p)]
+
+    def __getitem__(self, z):
+        covering = self._covering(z)
+        if (len(covering) == 1 and covering[0][1][1:] == (0, 0) 
+                and tuple(covering[0][0].imshape) == tuple(self.imshape)):
+            part, offset = covering[0]
+            # index translation only, no copy unless dtype differs
+            return part[z - offset[0]].astype(self.dtype, copy=False)
+        im = np.full(self.imshape, self.fill, dtype=self.dtype)
+        for part, (pz, py, px) in covering:
+            h, w = part.imshape
+            im[py : py + h, px : px + w] = part[z - pz].astype(self.dtype, copy=False)
+        return im
+
+    def subslice(self, z, Y, X):
+        im = np.full((len(Y), len(X)), self.fill, dtype=self.dtype)
+        for part, (pz, py, px) in self._covering(z):
+            iy, Yp = part_indices(Y, py, part.imshape[0])
+            ix, Xp = part_indices(X, px, part.imshape[1])
+            if len(Yp) and len(Xp):
+                im[np.ix_(iy, ix)] = part.subslice(z - pz, Yp, Xp).astype(
+                        self.dtype, copy=False)
+        return im
+
+
+def part_indices(S, offset, length):
+    '''For indices S into a volume, returns positions in S and indices into a 
+    part placed at offset with given length. Ranges stay ranges.'''
+
+    S_array = np.asarray(S)
+    inside = np.flatnonzero((S_array >= offset) & (S_array < offset + length))
+    P = S_array[inside] - offset
+    if isinstance(S, range) and len(P):
+        P = range(int(P[0]), int(P[-1]) + 1, S.step)
+    return inside, P
+
+
 class npSlicer(Slicer):
     ''' A silly slicer, allowing vis3d to work on numpy arrays. '''
 
+    partial_reads = True
+    strided_reads = True
+
     def __init__(self, vol):
 
         super().__init__()   
@@ -269,6 +768,458 @@ class npSlicer(Slicer):
     def __getitem__(self, z):
         return self._vol[z]
 
+    def reopen(self):
+        return self
+
+    def loadvol(self, verbose=False, max_memory=None, **kwargs):
+        if max_memory is None or self.nbytes() <= max_memory:
+            return np.array(self._vol)
+        return super().loadvol(verbose, max_memory, **kwargs)
+
+
+class NpySlicer(npSlicer):
+    '''Memory-maps a .npy file, slices are views without copying.'''
+
+    def __init__(self, filename):
+
+        super().__init__(np.load(filename, mmap_mode='r'))
+        self.filename = filename
+
+
+class RawSlicer(npSlicer):
+    '''Memory-maps a headerless raw volume. The volume is described by a 
+    sidecar .json file with the same name, containing shape (z, y, x), dtype 
+    (e.g. "uint16" or ">f4" for big-endian) and optionally offset in bytes.'''
+
+    def __init__(self, filename):
+
+        with open(os.path.splitext(filename)[0] + '.json') as f:
+            info = json.load(f)
+        vol = np.memmap(filename, dtype=np.dtype(info['dtype']), mode='r',
+                        offset=info.get('offset', 0), shape=tuple(info['shape']))
+        super().__init__(vol)
+        self.filename = filename
+
+    def _cache_files(self):
+        return [self.filename, os.path.splitext(self.filename)[0] + '.json']
+
+
+class NrrdSlicer(npSlicer):
+    '''Memory-maps an uncompressed (raw encoded) 3D nrrd file, with attached 
+    or detached data.'''
+
+    types = {np.dtype('int8'): ['signed char', 'int8', 'int8_t'],
+             np.dtype('uint8'): ['uchar', 'unsigned char', 'uint8', 'uint8_t'],
+             np.dtype('int16'): ['short', 'short int', 'signed short', 
+                    'signed short int', 'int16', 'int16_t'],
+             np.dtype('uint16'): ['ushort', 'unsigned short', 
+                    'unsigned short int', 'uint16', 'uint16_t'],
+             np.dtype('int32'): ['int', 'signed int', 'int32', 'int32_t'],
+             np.dtype('uint32'): ['uint', 'unsigned int', 'uint32', 'uint32_t'],
+             np.dtype('int64'): ['longlong', 'long long', 'long long int', 
+                    'signed long long', 'signed long long int', 'int64', 
+                    'int64_t'],
+             np.dtype('uint64'): ['ulonglong', 'unsigned long long', 
+                    'unsigned long long int', 'uint64', 'uint64_t'],
+             np.dtype('float32'): ['float'],
+             np.dtype('float64'): ['double']}
+
+    def __init__(self, filename):
+
+        header = {}
+        with open(filename, 'rb') as f:
+            magic = f.readline()
+            if not magic.startswith(b'NRRD'):
+                raise Exception(f'{filename} is not a nrrd file.')
+            for line in f:
+                line = line.decode('latin-1').strip()
+                if not line:  # blank line ends header, attached data follows
+                    break
+                if line.startswith('#') or ':' not in line:
+                    continue
+                key, value = line.split(':', 1)
+                header[key.strip().lower()] = value.lstrip('=').strip()
+            offset = f.tell()
+
+        if header.get('encoding') != 'raw':
+            raise Exception(f"Only raw nrrd is supported, not {header.get('encoding')}.")
+        if int(header['dimension']) != 3:
+            raise Exception(f"Only 3D nrrd is supported.")
+        dtype = next(d for d, names in self.types.items() 
+                     if header['type'] in names)
+        if dtype.itemsize > 1:
+            endian = header.get('endian', 'little')
+            dtype = dtype.newbyteorder('>' if endian == 'big' else '<')
+        shape = tuple(int(n) for n in header['sizes'].split())[::-1]  # z, y, x 
+
+        datafile = header.get('data file', header.get('datafile'))
+        if datafile is None:
+            datafile = filename
+        else:
+            datafile = os.path.join(os.path.dirname(filename), datafile)
+            offset = 0
+        byteskip = int(header.get('byte skip', header.get('byteskip', 0)))
+        if byteskip < 0:
+            raise Exception('Nrrd with negative byte skip is not supported.')
+        offset += byteskip
+
+        vol = np.memmap(datafile, dtype=dtype, mode='r', offset=offset, 
+                        shape=shape)
+        super().__init__(vol)
+        self.filename = filename
+
+
+def read_nifti_header(f):
+    '''Reads NIfTI-1 or NIfTI-2 header from an open file. Returns shape 
+    (z, y, x), dtype and offset of the data. For 4D volumes, the first volume
+    is used.'''
+
+    types = {2: 'u1', 4: 'i2', 8: 'i4', 16: 'f4', 64: 'f8', 256: 'i1', 
+             512: 'u2', 768: 'u4', 1024: 'i8', 1280: 'u8'}
+    header = f.read(540)
+    for endian in '<>':
+        sizeof_hdr = struct.unpack(endian + 'i', header[:4])[0]
+        if sizeof_hdr == 348:  # NIfTI-1
+            datatype = struct.unpack(endian + 'h', header[70:72])[0]
+            dim = struct.unpack(endian + '8h', header[40:56])
+            offset = int(struct.unpack(endian + 'f', header[108:112])[0])
+            break
+        if sizeof_hdr == 540:  # NIfTI-2
+            datatype = struct.unpack(endian + 'h', header[12:14])[0]
+            dim = struct.unpack(endian + '8q', header[16:80])
+            offset = struct.unpack(endian + 'q', header[168:176])[0]
+            break
+    else:
+        raise Exception('Not a NIfTI file.')
+    if datatype not in types:
+        raise Exception(f'NIfTI datatype {datatype} is not supported.')
+    if dim[0] < 3:
+        raise Exception(f'NIfTI volume has only {dim[0]} dimensions.')
+    return (dim[3], dim[2], dim[1]), np.dtype(endian + types[datatype]), offset
+
+
+class NiftiSlicer(npSlicer):
+    '''Memory-maps an uncompressed .nii file.'''
+
+    def __init__(self, filename):
+
+        with open(filename, 'rb') as f:
+            shape, dtype, offset = read_nifti_header(f)
+        vol = np.memmap(filename, dtype=dtype, mode='r', offset=offset, 
+                        shape=shape)
+        super().__init__(vol)
+        self.filename = filename
+
+
+class GzNiftiSlicer(Slicer):
+    '''Reads slices from a gzip compressed .nii.gz file, using an index of
+    seek points (see gzindex.py). The index is built when the file is first
+    opened, which takes as long as decompressing the file, and saved for
+    later. Index points are spaced by span bytes, at least a slice.'''
+
+    def __init__(self, filename, span=2**22):
+        import gzip
+        import gzindex
+
+        super().__init__()
+        self.filename = filename
+        with gzip.open(filename) as f:
+            shape, self.dtype, self._offset = read_nifti_header(f)
+        self._len = shape[0]
+        self.imshape = shape[1:]
+        self._slicebytes = int(np.prod(self.imshape)) * self.dtype.itemsize
+        self._index = gzindex.GzipIndex(filename, max(span, self._slicebytes))
+
+    def __len__(self):
+        return self._len
+
+    def reopen(self):
+        return self  # each read opens the file
+
+    def __getitem__(self, z):
+        return self._timed('getitem', z, 
+                lambda: self._index.read(self._offset + z * self._slicebytes, 
+                                         self._slicebytes),
+                lambda b: np.frombuffer(b, self.dtype).reshape(self.imshape))
+
+    def _fill(self, vol, verbose=False, workers=None):
+        ''' Decompresses the file sequentially, which is faster than reading
+        each slice from the nearest index point.'''
+        import gzip
+
+        with gzip.open(self.filename) as f:
+            f.seek(self._offset)
+            for z in range(len(self)):
+                if verbose:
+                    print(f'slice {z}/{len(self)}')
+                vol[z] = np.frombuffer(f.read(self._slicebytes), 
+                                       self.dtype).reshape(self.imshape)
+
+
+class RunLengthSlicer(Slicer):
+    '''Keeps a label volume (e.g. a segmentation) in memory as runs of equal
+    values along rows of each slice, built by reading each slice of a slicer
+    once. For labels with large uniform regions, this takes a small fraction
+    of the memory of the dense volume, and slices are decoded quickly.'''
+
+    def __init__(self, slicer, verbose=False):
+
+        super().__init__()
+        self.filename = slicer.filename
+        self.dtype = np.dtype(slicer.dtype)
+        self.imshape = tuple(slicer.imshape)
+        self.range = slicer.range
+        values, lengths = [], []
+        self._offsets = np.zeros(len(slicer) + 1, dtype=np.int64)
+        for z in range(len(slicer)):
+            if verbose:
+                print(f'slice {z}/{len(slicer)}')
+            v, l = encode_runs(np.asarray(slicer[z]).ravel())
+            values.append(v)
+            lengths.append(l)
+            self._offsets[z + 1] = self._offsets[z] + len(v)
+        self._values = np.concatenate(values)
+        self._lengths = np.concatenate(lengths)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def reopen(self):
+        return self  # read-only arrays in memory
+
+    def runs(self, z):
+        ''' Values and lengths of runs in slice z, row after row.'''
+        runs = slice(self._offsets[z], self._offsets[z + 1])
+        return self._values[runs], self._lengths[runs]
+
+    def __getitem__(self, z):
+        values, lengths = self.runs(z)
+        return np.repeat(values, lengths).reshape(self.imshape)
+
+    def runs_nbytes(self):
+        ''' Memory used by runs, compare with nbytes of the dense volume.'''
+        return self._values.nbytes + self._lengths.nbytes + self._offsets.nbytes
+
+
+def encode_runs(a):
+    '''Run-length encodes 1D array, returning values and lengths of runs.'''
+    starts = np.flatnonzero(a[1:] != a[:-1]) + 1
+    starts = np.concatenate(([0], starts))
+    lengths = np.diff(np.append(starts, len(a))).astype(np.uint32)
+    return a[starts], lengths
+
+
+class ThreadReader:
+    ''' Gives each thread its own reopened slicer, or, if the slicer can't be
+    reopened, the slicer itself and a lock for reading one thread at a time.'''
+
+    def __init__(self, slicer):
+        self.slicer = slicer
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def reader(self):
+        ''' Slicer for this thread, and lock to hold while reading from it.'''
+        if not hasattr(self._local, 'reader'):
+            self._local.reader = self.slicer.reopen()
+            self._local.lock = contextlib.nullcontext()
+            if self._local.reader is None:
+                self._local.reader, self._local.lock = self.slicer, self._lock
+        return self._local.reader, self._local.lock
+
+    def __getitem__(self, z):
+        reader, lock = self.reader()
+        with lock:
+            return reader[z]
+
+    def subslice(self, z, Y, X):
+        reader, lock = self.reader()
+        with lock:
+            return reader.subslice(z, Y, X)
+
+
+class SharedReader:
+    ''' Reads slices of several slicers using one pool of worker threads and
+    one cache of at most max_bytes, e.g. for several volumes shown together.
+    Requests for the same slice are merged, and requests are served by 
+    priority (lower first), so shown slices are read before prefetched 
+    neighbours. Workers read through a ThreadReader for each slicer.'''
+
+    def __init__(self, max_bytes=2**30, workers=2):
+        self.max_bytes = max_bytes
+        self._cache = collections.OrderedDict()  # (id, z): slice
+        self._nbytes = 0
+        self._futures = {}  # (id, z): future, for slices queued or being read
+        self._queued = {}  # (id, z): priority, for slices in the queue
+        self._queue = []  # heap of (priority, count, key, slicer, z)
+        self._count = 0
+        self._condition = threading.Condition()
+        self._readers = {}  # id: ThreadReader
+        for _ in range(workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def cached(self, slicer, z):
+        ''' Slice z if it is in the cache, else None.'''
+        with self._condition:
+            key = (id(slicer), z)
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+    def request(self, slicer, z, priority=0):
+        ''' Returns a future for slice z. A repeated request returns the same
+        future, and may raise its priority.'''
+        key = (id(slicer), z)
+        with self._condition:
+            if key in self._cache:
+                future = concurrent.futures.Future()
+                future.set_result(self._cache[key])
+                return future
+            future = self._futures.get(key)
+            if future is None:
+                future = concurrent.futures.Future()
+                self._futures[key] = future
+            elif key not in self._queued or self._queued[key] <= priority:
+                return future  # being read, or queued with higher priority
+            self._queued[key] = priority  # earlier entry becomes stale
+            heapq.heappush(self._queue, (priority, self._count, key, slicer, z))
+            self._count += 1
+            self._condition.notify()
+            return future
+
+    def prefetch(self, slicer, z, n=2):
+        ''' Queues n slices on each side of z with priority given by their 
+        distance. Earlier prefetches for this slicer which are still queued
+        are dropped.'''
+        with self._condition:
+            for key, priority in list(self._queued.items()):
+                if key[0] == id(slicer) and priority > 0:
+                    del self._queued[key]
+                    self._futures.pop(key).cancel()
+        for d in range(1, n + 1):
+            for i in (z + d, z - d):
+                if 0 <= i < len(slicer):
+                    self.request(slicer, i, priority=d)
+
+    def _reader(self, slicer):
+        ''' ThreadReader for slicer, replaced if the id was reused.'''
+        with self._condition:
+            reader = self._readers.get(id(slicer))
+            if reader is None or reader.slicer is not slicer:
+                reader = self._readers[id(slicer)] = ThreadReader(slicer)
+            return reader
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+                priority, _, key, slicer, z = heapq.heappop(self._queue)
+                if self._queued.get(key) != priority:
+                    continue  # stale entry, dropped or requeued
+                del self._queued[key]
+                future = self._futures[key]
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                im = self._reader(slicer)[z]
+            except Exception as e:
+                with self._condition:
+                    self._futures.pop(key, None)
+                future.set_exception(e)
+                continue
+            with self._condition:
+                self._futures.pop(key, None)
+                self._cache[key] = im
+                self._nbytes += im.nbytes
+                while self._nbytes > self.max_bytes and len(self._cache) > 1:
+                    _, old = self._cache.popitem(last=False)
+                    self._nbytes -= old.nbytes
+            future.set_result(im)
+
+
+class RoiProfile:
+    ''' Mean, min and max of rows Y and columns X in each slice, computed in
+    background by worker threads reading only that part of each slice. 
+    Slices are read in order of distance from slice z, and results fill in
+    while computing (nan for slices not done yet). Call cancel to stop, e.g.
+    when the rectangle changes. Workers read through a ThreadReader.'''
+
+    def __init__(self, slicer, Y, X, z=0, workers=None):
+        self.Y, self.X = Y, X
+        self.mean = np.full(len(slicer), np.nan)
+        self.min = np.full(len(slicer), np.nan)
+        self.max = np.full(len(slicer), np.nan)
+        self.done = 0
+        self.error = None
+        self._order = iter(sorted(range(len(slicer)), key=lambda i: (abs(i - z), i)))
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        reader = ThreadReader(slicer)
+        for _ in range(workers or default_workers()):
+            threading.Thread(target=self._work, args=(reader,), daemon=True).start()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def finished(self):
+        return self.done == len(self.mean) or self.error is not None
+
+    def _work(self, reader):
+        try:
+            while not self._cancelled.is_set():
+                with self._lock:
+                    z = next(self._order, None)
+                if z is None:
+                    return
+                roi = reader.subslice(z, self.Y, self.X)
+                self.mean[z], self.min[z], self.max[z] = roi.mean(), roi.min(), roi.max()
+                with self._lock:
+                    self.done += 1
+        except Exception as e:
+            self.error = e
+            self._cancelled.set()
+
+
+class Timings:
+    ''' Collects timings, as records with call name, slice index and values 
+    (times in seconds, sizes in bytes). Used by slicers and by vis3d.'''
+
+    def __init__(self):
+        self.records = []
+        self.start = time.time()
+
+    def add(self, call, z, **values):
+        self.records.append(dict(call=call, z=z, 
+                                 t=time.time() - self.start, **values))
+
+    def last(self, call=None):
+        ''' Last record, optionally of given call, or None.'''
+        for record in reversed(self.records):
+            if call is None or record['call'] == call:
+                return record
+
+    def summary(self):
+        ''' Count and mean values for each call.'''
+        summary = {}
+        for record in self.records:
+            s = summary.setdefault(record['call'], {'count': 0})
+            s['count'] += 1
+            for key, value in record.items():
+                if key not in ('call', 'z', 't'):
+                    s[key] = s.get(key, 0) + value
+        for s in summary.values():
+            for key in s:
+                if key != 'count':
+                    s[key] /= s['count']
+        return summary
+
+    def save(self, filename, **info):
+        ''' Saves records and summary as json, with optional extra info.'''
+        with open(filename, 'w') as f:
+            json.dump(dict(info, summary=self.summary(), records=self.records),
+                      f, indent=1)
+
 
 def PIL_mode_to_np_dtype(mode):
     '''This is neither complete, nor have all cases been tested!!! ''' 
@@ -282,6 +1233,184 @@ def PIL_mode_to_np_dtype(mode):
     return dtype
 
 
+def subindexing(Y, X):
+    '''Index for rows Y and columns X. Ranges give slices (and views), other 
+    sequences give open mesh via np.ix_.'''
+
+    if isinstance(Y, range) and isinstance(X, range):
+        return (slice(Y.start, Y.stop, Y.step), slice(X.start, X.stop, X.step))
+    return np.ix_(Y, X)
+
+
+def read_tiff_rows(page, Y, X, workers=1):
+    '''Reads rows Y and columns X from a tiff page, decoding only the strips 
+    which contain rows Y, using workers threads. For uncompressed contiguous
+    pages, only rows Y are read, and for tiled pages, only tiles containing
+    rows Y and columns X. Multi-sample and compressed single-strip pages are
+    read fully, see has_partial_reads.'''
+
+    if is_raw_contiguous(page):
+        return read_raw_rows(page, Y, X)
+    if is_single_tiled(page):
+        return read_tiff_tiles(page, Y, X, workers)
+    if (page.is_tiled or page.samplesperpixel != 1 
+            or len(page.dataoffsets) < 2):
+        return page.asarray(maxworkers=workers)[subindexing(Y, X)]
+
+    out = np.empty((len(Y), len(X)), dtype=page.dtype)
+    if isinstance(X, range):
+        X = slice(X.start, X.stop, X.step)
+    rowsperstrip = page.rowsperstrip
+    fh = page.parent.filehandle
+    needed = sorted(set(y // rowsperstrip for y in Y))
+    data = []
+    for s in needed:
+        fh.seek(page.dataoffsets[s])
+        data.append(fh.read(page.databytecounts[s]))
+    decode = lambda s, d: page.decode(d, s)[0].reshape(-1, page.imagewidth)
+    strips = dict(zip(needed, thread_map(decode, needed, data, workers=workers)))
+    for i, y in enumerate(Y):
+        s = y // rowsperstrip
+        out[i] = strips[s][y - s * rowsperstrip, X]
+    return out
+
+
+def has_partial_reads(page):
+    '''Whether read_tiff_rows reads only a part of the page.'''
+
+    return (is_raw_contiguous(page) or is_single_tiled(page) or 
+            (is_stripped(page) and len(page.dataoffsets) > 1))
+
+
+def is_single_tiled(page):
+    '''Whether tiff page consists of 2D single-sample tiles.'''
+
+    return (page.is_tiled and page.samplesperpixel == 1 
+            and getattr(page, 'imagedepth', 1) == 1)
+
+
+def read_tiff_tiles(page, Y, X, workers=1):
+    '''Reads rows Y and columns X from a tiled tiff page, reading and 
+    decoding (using workers threads) only the tiles which contain them.'''
+
+    th, tw = page.tilelength, page.tilewidth
+    across = -(-page.imagewidth // tw)  # tiles per row
+    Y, X = np.asarray(Y), np.asarray(X)
+    rows, cols = np.unique(Y // th), np.unique(X // tw)
+    needed = [(r, c) for r in rows for c in cols]
+    fh = page.parent.filehandle
+    data = []
+    for r, c in needed:
+        fh.seek(page.dataoffsets[r * across + c])
+        data.append(fh.read(page.databytecounts[r * across + c]))
+    decode = lambda rc, d: page.decode(d, rc[0] * across + rc[1])[0].reshape(th, tw)
+    tiles = thread_map(decode, needed, data, workers=workers)
+    out = np.empty((len(Y), len(X)), dtype=page.dtype)
+    for (r, c), tile in zip(needed, tiles):
+        iy, ix = np.flatnonzero(Y // th == r), np.flatnonzero(X // tw == c)
+        out[np.ix_(iy, ix)] = tile[np.ix_(Y[iy] - r * th, X[ix] - c * tw)]
+    return out
+
+
+def is_raw_contiguous(page):
+    '''Whether tiff page is stored uncompressed as one block of rows, such 
+    that a row can be read from its offset.'''
+
+    dtype = np.dtype(page.dtype)
+    return (not page.is_tiled and page.samplesperpixel == 1
+            and page.compression == 1 and page.predictor == 1
+            and dtype.kind in 'uif' and bool(page.is_contiguous)
+            and sum(page.databytecounts) == 
+                page.imagelength * page.imagewidth * dtype.itemsize)
+
+
+def read_raw_rows(page, Y, X):
+    '''Reads rows Y of uncompressed contiguous tiff page, reading runs of 
+    consecutive rows at once, and returns their columns X.'''
+
+    dtype = np.dtype(page.dtype).newbyteorder(page.parent.byteorder)
+    rowbytes = page.imagewidth * dtype.itemsize
+    fh = page.parent.filehandle
+    out = np.empty((len(Y), len(X)), dtype=page.dtype)
+    X = slice(X.start, X.stop, X.step) if isinstance(X, range) else X
+    Y = list(Y)
+    i = 0
+    while i < len(Y):
+        j = i + 1
+        while j < len(Y) and Y[j] == Y[j - 1] + 1:
+            j += 1
+        fh.seek(page.dataoffsets[0] + Y[i] * rowbytes)
+        rows = np.frombuffer(fh.read((j - i) * rowbytes), dtype=dtype)
+        out[i:j] = rows.reshape(j - i, page.imagewidth)[:, X]
+        i = j
+    return out
+
+
+def is_stripped(page):
+    '''Whether tiff page consists of single-sample strips, which we can 
+    read and decode ourselves.'''
+
+    return not page.is_tiled and page.samplesperpixel == 1
+
+
+def read_tiff_strips(page):
+    '''Reads (undecoded) bytes of all strips of a tiff page.'''
+
+    fh = page.parent.filehandle
+    strips = []
+    for offset, bytecount in zip(page.dataoffsets, page.databytecounts):
+        fh.seek(offset)
+        strips.append(fh.read(bytecount))
+    return strips
+
+
+def decode_tiff_strips(page, strips, workers=1):
+    '''Decodes strips read by read_tiff_strips into an image, using workers
+    threads.'''
+
+    decode = lambda i, d: page.decode(d, i)[0].reshape(-1, page.imagewidth)
+    im = np.concatenate(thread_map(decode, range(len(strips)), strips, 
+                                   workers=workers))
+    return im[:page.imagelength]
+
+
+def default_workers():
+    '''Default number of threads for reading and decoding.'''
+    return min(8, os.cpu_count() or 1)
+
+
+_thread_pools = {}
+
+def thread_map(function, *iterables, workers=1):
+    '''Like list(map(function, *iterables)), but using a shared pool of 
+    workers threads. Decoders (zlib, imagecodecs) release the GIL, so this 
+    speeds up decoding. Must not be called from a task in the same pool.'''
+
+    if workers <= 1:
+        return list(map(function, *iterables))
+    if workers not in _thread_pools:
+        _thread_pools[workers] = concurrent.futures.ThreadPoolExecutor(
+                workers, thread_name_prefix='slicers')
+    return list(_thread_pools[workers].map(function, *iterables))
+
+
+def read_bytes(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+
+def count_bytes(raw):
+    '''Number of bytes in read data: bytes, arrays, or lists of those.'''
+
+    if isinstance(raw, np.ndarray):
+        return raw.nbytes
+    if isinstance(raw, (bytes, bytearray)):
+        return len(raw)
+    if isinstance(raw, (list, tuple)):
+        return sum(count_bytes(r) for r in raw)
+    return 0
+
+
 def list_imfiles(folder, ext=['.tif', '.tiff']):
 
     files = os.listdir(folder)
@@ -292,7 +1421,7 @@ def list_imfiles(folder, ext=['.tif', '.tiff']):
             ext = os.path.splitext(f)[-1].lower()
             if ext in extlist:
                 hist[ext] += 1
-        ext = max(hist)
+        ext = [max(hist, key=hist.get)]  # most common extension
 
     # usint `in ext` to allow for both .tif and .tiff
     files = [os.path.join(folder, f) for f in files
@@ -301,11 +1430,48 @@ def list_imfiles(folder, ext=['.tif', '.tiff']):
     return files
 
 
+def text_slicer(filename):
+    '''A single file containing volume name, resolved by recursion.'''
+
+    with open(filename) as f:
+        content = f.read().strip()
+    return slicer(content)
+
+
+# Slicers for single files, by (lowercase) extension. If more slicers are 
+# given for an extension, they are tried in order. 
+formats = {}
+
+
+def register_format(extensions, *factories):
+    '''Registers slicers (or functions returning slicers) for extensions.'''
+
+    for ext in extensions:
+        formats[ext] = list(factories)
+
+
+#  TiffFileSlicer seems to handle strange filenames better than FileSlicer
+register_format(['.tif', '.tiff'], TiffFileSlicer, FileSlicer)
+register_format(['.vgi'], VgiSlicer)
+register_format(['.vol'], lambda source: VgiSlicer(source.replace('.vol', '.vgi')))
+register_format(['.txm', '.txrm'], TxmSlicer)
+register_format(['.npy'], NpySlicer)
+register_format(['.raw'], RawSlicer)
+register_format(['.nrrd', '.nhdr'], NrrdSlicer)
+register_format(['.nii'], NiftiSlicer)
+register_format(['.gz'], GzNiftiSlicer)  # only .nii.gz
+register_format(['.stitch'], CompositeSlicer.from_file)
+register_format(['.txt'], text_slicer)
+
+
 def slicer(source):
     '''Given a source (tries to) resolve which slicer to use. This supports
-    vgi+vol files, txm files, numpy arrays, a folder containing tiff images, 
-    an url of tiff stacked file, a tiff stacked file, or a text file containing 
-    a name of any of such files volume.
+    vgi+vol files, txm files, numpy arrays, npy files, raw files with json 
+    sidecar, raw encoded nrrd files, nii and nii.gz files, a folder 
+    containing tiff images, an url of tiff stacked file, an url of a slice 
+    server, a tiff stacked file, a text file containing a name of any of such 
+    files volume, or a .stitch file combining any of these volumes. Single 
+    files are resolved by extension, using slicers registered in formats.
 
     '''
 
@@ -323,32 +1489,19 @@ def slicer(source):
           ('tif' in os.path.splitext(source)[-1].lower())):
         return FileSlicer.from_url(source)
 
-    else:  # a single file
-        ext = os.path.splitext(source)[-1]
-        
-        if 'tif' in ext:
-            #  TiffFileSlicer seems to handle strange filenames
-            #  better than FileSlicer
-            try:
-                return TiffFileSlicer(source) 
-            except:
-                return FileSlicer(source) 
-        
-        if ext == '.vgi':
-            return VgiSlicer(source)
-        
-        if ext == '.vol':
-            return VgiSlicer(source.replace('.vol', '.vgi'))
+    elif (len(source)>4) and (source[:4]=='http'):  # served by slice_server
+        return RemoteSlicer(source)
 
-        if ext == '.txm' or ext=='.txrm':
-            return TxmSlicer(source)
-        
-        # A single file containing volume name, resolved by recursion.
-        elif ext=='.txt':
-            with open(source) as f:
-                content = f.read().strip()
-                return slicer(content) 
-        else:
+    else:  # a single file
+        ext = os.path.splitext(source)[-1].lower()
+        if ext not in formats:
             raise Exception(f"Couldn't resolve volume {source}.")
+        *fallbacks, factory = formats[ext]
+        for fallback in fallbacks:
+            try:
+                return fallback(source)
+            except Exception:
+                pass
+        return factory(source)
     
 # %%
@@ -8,10 +8,278 @@ The main function of the script starts by parsing the command line arguments
 using `argparse`.
 """
 
-import numpy as np
-import slicers
 import argparse
 import os
+import sys
+import time
+import json
+import struct
+import contextlib
+import queue
+import threading
+try:
+    import resource  # for peak memory, not available on Windows
+except ImportError:
+    resource = None
+
+
+class Progress:
+    ''' Keeps track of progress, throughput and time spent in each stage, and
+    prints a progress line at most once every interval seconds.'''
+
+    stages = ('read', 'normalize', 'resample', 'encode', 'write')
+
+    def __init__(self, total, interval=1):
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.times = dict.fromkeys(self.stages, 0)
+        self.start = time.perf_counter()
+        self.printed = self.start
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        t = time.perf_counter()
+        yield
+        self.times[name] += time.perf_counter() - t
+
+    def step(self):
+        ''' Called when an output slice is written.'''
+        self.done += 1
+        now = time.perf_counter()
+        if now - self.printed > self.interval or self.done == self.total:
+            self.printed = now
+            print('\r' + self.line(), end='', flush=True)
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def line(self):
+        elapsed = self.elapsed()
+        rate = self.done / elapsed
+        eta = (self.total - self.done) / rate if rate > 0 else float('inf')
+        return (f'{self.done}/{self.total} slices, {rate:.2f} slices/s, '
+                f'read {self.bytes_read / elapsed / 2**20:.1f} MB/s, '
+                f'written {self.bytes_written / elapsed / 2**20:.1f} MB/s, '
+                f'ETA {format_seconds(eta)}, '
+                f'peak RSS {peak_rss() / 2**20:.0f} MB   ')
+
+    def report(self):
+        ''' Summary with stage times. Reading, computing (normalize, resample,
+        encode) and writing run in parallel threads, so stage times may add up
+        to more than the elapsed time. The slowest of the three limits the 
+        throughput.'''
+        return {'slices': self.done,
+                'seconds': self.elapsed(),
+                'bytes_read': self.bytes_read,
+                'bytes_written': self.bytes_written,
+                'peak_rss': peak_rss(),
+                'stages': dict(self.times)}
+
+
+def print_report(report):
+    print(f'Time {format_seconds(report["seconds"])}, stages:')
+    for name, seconds in report['stages'].items():
+        share = 100 * seconds / max(report['seconds'], 1e-9)
+        print(f'  {name:<10} {seconds:10.2f} s {share:5.1f}%')
+
+
+def peak_rss():
+    ''' Peak resident memory of this process in bytes, 0 if not available.'''
+    if resource is None:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else 1024 * rss  # kB on linux
+
+
+BIGTIFF_SIZE = 2**32 - 2**28  # larger files are BigTIFF, leaving room for tags
+
+
+def part_filename(destination, i, n):
+    ''' Filename of part i (counting from 0) of n shards.'''
+    root, ext = os.path.splitext(destination)
+    return f'{root}.part{i:03d}of{n:03d}{ext or ".tif"}'
+
+
+def parse_shard(shard):
+    ''' Parses shard given as i/N, with i counting from 0.'''
+    i, n = (int(v) for v in shard.split('/'))
+    if not 0 <= i < n:
+        raise ValueError(f'Shard {shard} should be i/N with 0 <= i < N.')
+    return i, n
+
+
+def shard_argument(value):
+    ''' Argument type for --shard, which is kept as given.'''
+    try:
+        parse_shard(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+                f'{value} should be i/N with 0 <= i < N.')
+    return value
+
+
+def positive_int(value):
+    ''' Argument type for sizes, as a queue of size 0 would be unbounded.'''
+    value = int(value)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f'{value} should be at least 1.')
+    return value
+
+
+class Checkpoint:
+    ''' Records how many output slices are written to the destination, and 
+    the size of the destination at that point. Settings are stored to make 
+    sure that the job is resumed with the same arguments.'''
+
+    def __init__(self, destination, settings, interval=60):
+        self.filename = destination + '.checkpoint'
+        self.destination = destination
+        self.settings = settings
+        self.interval = interval
+        self.saved = time.perf_counter()
+
+    def load(self):
+        ''' Returns number of written slices and destination size, or None if
+        there is no checkpoint. Raises if settings differ.'''
+        if not os.path.exists(self.filename):
+            return None
+        with open(self.filename) as f:
+            checkpoint = json.load(f)
+        if checkpoint['settings'] != self.settings:
+            raise ValueError(f'Checkpoint {self.filename} was made with other '
+                             f'settings {checkpoint["settings"]}.')
+        return checkpoint['done'], checkpoint['size']
+
+    def save(self, writer, done, force=False):
+        ''' Saves checkpoint, if interval passed since the last save.'''
+        now = time.perf_counter()
+        if not force and now - self.saved < self.interval:
+            return
+        self.saved = now
+        writer.filehandle.flush()
+        with open(self.destination, 'rb') as f:
+            os.fsync(f.fileno())  # written slices are on disk before checkpoint
+        checkpoint = {'settings': self.settings, 'done': done, 
+                      'size': os.path.getsize(self.destination)}
+        with open(self.filename + '.tmp', 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(self.filename + '.tmp', self.filename)
+
+    def remove(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+
+def truncate_tiff(filename, size):
+    ''' Truncates tif file to size, which needs to be a page boundary, and 
+    ends the chain of pages at the last remaining page.'''
+    os.truncate(filename, size)
+    with open(filename, 'r+b') as f:
+        byteorder = {b'II': '<', b'MM': '>'}[f.read(2)]
+        version = struct.unpack(byteorder + 'H', f.read(2))[0]
+        if version == 43:  # BigTIFF
+            countformat, tagsize, offsetformat = 'Q', 20, 'Q'
+            f.read(4)
+        else:
+            countformat, tagsize, offsetformat = 'H', 12, 'I'
+        countsize = struct.calcsize(countformat)
+        offsetsize = struct.calcsize(offsetformat)
+        pointer = f.tell()  # position of offset to the first page
+        offset = struct.unpack(byteorder + offsetformat, f.read(offsetsize))[0]
+        while 0 < offset < size:
+            f.seek(offset)
+            count = struct.unpack(byteorder + countformat, f.read(countsize))[0]
+            pointer = offset + countsize + count * tagsize
+            f.seek(pointer)
+            offset = struct.unpack(byteorder + offsetformat, f.read(offsetsize))[0]
+        if offset != 0:  # points to a removed page
+            f.seek(pointer)
+            f.write(bytes(offsetsize))
+
+
+def read_ahead(iterable, size):
+    ''' Iterates over iterable in a background thread, keeping at most size 
+    items ready. Exceptions are raised in the consuming thread.'''
+
+    items = queue.Queue(size)
+    stop = threading.Event()  # set when the consumer stops early
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((StopIteration, None))
+        except BaseException as e:
+            put((None, e))
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is StopIteration:
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+class WriteBehind:
+    ''' Calls function on items in a background thread, in the order items 
+    are put. At most size items are waiting, after that put blocks. 
+    Exceptions from function are raised in put or close.'''
+
+    def __init__(self, function, size):
+        self.function = function
+        self.items = queue.Queue(size)
+        self.error = None
+        self.thread = threading.Thread(target=self.consume, daemon=True)
+        self.thread.start()
+
+    def consume(self):
+        while True:
+            item = self.items.get()
+            if item is StopIteration:
+                return
+            if self.error is None:  # after an error, items are discarded
+                try:
+                    self.function(item)
+                except BaseException as e:
+                    self.error = e
+
+    def put(self, item):
+        if self.error is not None:
+            raise self.error
+        self.items.put(item)
+
+    def close(self):
+        self.items.put(StopIteration)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def format_seconds(seconds):
+    if seconds == float('inf'):
+        return '?'
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}:{minutes:02d}:{seconds:02d}'
+
               
 def main():
     """
@@ -31,11 +299,23 @@ def main():
     - dtype: Specifies the destination dtype. If set to `uint8` or `uint16`, 
       values will be multiplied and casted. Note: this should only be used if 
       values are scaled to [0, 1], e.g. by using `vrange`.
+    - report: A filename for a json report with throughput and time spent in
+      each stage (read, normalize, resample, encode, write).
+    - shard: Given as i/N (with i from 0 to N-1), only the i-th of N parts of 
+      output slices is written, to a part file next to the destination. Parts
+      may be processed in parallel (e.g. as a job array) and then combined 
+      using `tiffify_merge`.
+    - checkpoint: Seconds between checkpoints when resuming, default is 60.
+    - readahead: Number of slices buffered between reading, computing and 
+      writing, which run in parallel threads, at least 1. Default is 4.
 
     Flags:
     - overwrite: If set, allows overwriting. Use with care.
     - blend: If set, uses a filter similar to Gaussian before sampling. Note 
       that this will make the script run much slower.
+    - resume: If set, progress is checkpointed next to the destination, and 
+      a job which was stopped continues from the last checkpoint when run 
+      again with the same arguments.
     """
     # Parsing command line arguments
     parser = argparse.ArgumentParser(description='Save volume as downscaled tif.')
@@ -46,12 +326,38 @@ def main():
     parser.add_argument('--dtype')
     parser.add_argument('--overwrite', action='store_true', default=False)
     parser.add_argument('--blend', action='store_true', default=False)
+    parser.add_argument('--report')
+    parser.add_argument('--shard', type=shard_argument)
+    parser.add_argument('--resume', action='store_true', default=False)
+    parser.add_argument('--checkpoint', type=float, default=60)
+    parser.add_argument('--readahead', type=positive_int, default=4)
     args = parser.parse_args()
 
+    # Imported after parsing arguments, such that --help is fast
+    import numpy as np
+    import tifffile
+    import slicers
+
     if args.destination is None:
         args.destination = 'tiffified_volume.tif'
+
+    if args.shard is not None:
+        shard, shards = parse_shard(args.shard)
+        args.destination = part_filename(args.destination, shard, shards)
     
-    if (not args.overwrite) and os.path.exists(args.destination):
+    resumed = None
+    if args.resume:
+        settings = {key: getattr(args, key) for key in 
+                    ['source', 'factor', 'vrange', 'dtype', 'blend', 'shard']}
+        checkpoint = Checkpoint(args.destination, settings, args.checkpoint)
+        try:
+            resumed = checkpoint.load()
+        except ValueError as e:
+            print(f'{e} Aborting')
+            return
+
+    if ((not args.overwrite) and (resumed is None) 
+            and os.path.exists(args.destination)):
         print('Destination already exists. Aborting')
         return
     
@@ -83,22 +389,66 @@ def main():
     Y = prepare_resampling(slicer.imshape[0])
     X = prepare_resampling(slicer.imshape[1])
 
+    # Indices (in Z) of output slices to be written
+    J = range(len(Z))
+    if args.shard is not None:
+        J = np.array_split(J, shards)[shard]
+        if len(J) == 0:  # more shards than output slices
+            print(f'Shard {args.shard} has no slices, writing empty part.')
+            tifffile.TiffWriter(args.destination).close()
+            return
+
     # Trying to read the first slice, to avoid opening file for writing if reading goes wrong.
     slice = slicer[0]    
     print(f'Writing volume of size {len(Z)}, {len(Y)}, {len(X)}... ', 
-        end='', flush=True)    
-    writer =  slicers.tifffile.TiffWriter(args.destination)
+        flush=True)    
+    if len(J) < len(Z):
+        print(f'Shard {args.shard} with slices {J[0]} to {J[-1]}.')
+    if resumed is None:
+        if args.dtype is not None:
+            itemsize = np.dtype(args.dtype).itemsize
+        else:  # normalizing gives floats
+            itemsize = 8 if args.vrange is not None else slice.dtype.itemsize
+        bigtiff = len(J) * len(Y) * len(X) * itemsize > BIGTIFF_SIZE
+        writer =  tifffile.TiffWriter(args.destination, bigtiff=bigtiff)
+        if args.resume:  # such that a job stopped early can be resumed
+            checkpoint.save(writer, 0, force=True)
+    else:
+        done, size = resumed
+        print(f'Resuming after {done} written slices.')
+        truncate_tiff(args.destination, size)  # removes slices after checkpoint
+        writer = tifffile.TiffWriter(args.destination, append=True)
+        J = J[done:]
+    progress = Progress(len(J))
+
+    # Reading, computing and writing run in separate threads, connected by 
+    # queues of at most args.readahead slices. The slicer is only used by the
+    # reading thread, and the writer only by the writing thread.
+
+    def read(z, Y=None, X=None):
+        with progress.stage('read'):
+            slice = slicer[z] if Y is None else slicer.subslice(z, Y, X)
+        progress.bytes_read += slice.nbytes
+        return slice
+
+    def finish(subslice):
+        with progress.stage('normalize'):
+            subslice = normalize(subslice)
+        with progress.stage('encode'):
+            subslice = cast(subslice)
+        return subslice
 
     def write(subslice):
-        subslice = normalize(subslice)
-        subslice = cast(subslice)
-        writer.write(subslice)
+        with progress.stage('write'):
+            writer.write(subslice)
+        progress.bytes_written += subslice.nbytes
+        progress.step()
+        if args.resume:
+            checkpoint.save(writer, (resumed or (0,))[0] + progress.done)
 
     if not args.blend:
-        subindexing = np.ix_(Y, X)    
-        for z in Z:
-            slice = slicer[z]
-            write(slice[subindexing])   
+        subslices = read_ahead((read(Z[j], Y, X) for j in J), args.readahead)
+        outputs = (finish(subslice) for subslice in subslices)
     else:
         # Blending is achieved using a gaussian kernel of size given by factor. 
         # Even factor uses 1-element overlap, odd factor covers without overlap.
@@ -127,8 +477,8 @@ def main():
         y_weights = prepare_weights(Y, slicer.imshape[0]).reshape(-1, 1)
         x_weights = prepare_weights(X, slicer.imshape[1])
 
-        def resample_and_write(in_array, temp_array, out_array, writer):
-            ''' 2D blend, resample, and write to file'''
+        def resample(in_array, temp_array, out_array):
+            ''' 2D blend and resample'''
             in_array = in_array * x_weights
             for i, x in enumerate(X):
                 temp_array[:, i] = in_array[:, max(x - hf, 0) : x + hf + 1].sum(axis=1)
@@ -136,41 +486,139 @@ def main():
             temp_array = y_weights * temp_array
             for i, y in enumerate(Y):
                 out_array[i, :] = temp_array[max(y - hf, 0) : y + hf + 1, :].sum(axis=0)            
-            write(out_array.astype(intype))  
-
-        # Preallocating arrays for 2D blending
-        temp_array = np.zeros((slicer.imshape[0], len(X)), dtype=float)
-        out_array = np.zeros((len(Y), len(X)), dtype=float)   
-
-        # Special treatment for the first slice which may have a smaller block
-        this_slice = z_weights[0] * slice.astype(float)
-        for i in range(1, Z[0] + hf + 1):
-            slice = slicer[i]
-            this_slice += z_weights[i] * slice.astype(float)
-        resample_and_write(this_slice, temp_array, out_array, writer)
-
-        # Slices in the middle
-        for z in Z[1:-1]:
-            if not overlap:
-                slice = slicer[z - hf]
-            this_slice = z_weights[z - hf] * slice.astype(float) 
-            for i in range(- hf + 1, hf + 1):
-                slice = slicer[z + i]
-                this_slice += z_weights[z + i] * slice.astype(float)
-            resample_and_write(this_slice, temp_array, out_array, writer)
-        
-        # Special treatment for the last slice which may have a smaller block
-        if not overlap:
-            slice = slicer[Z[-1] - hf]
-        this_slice = z_weights[Z[-1] - hf] * slice.astype(float)
-        for i in range(Z[-1] - hf + 1, len(slicer)):
-            slice = slicer[i]
-            this_slice += z_weights[i] * slice.astype(float)
-        resample_and_write(this_slice, temp_array, out_array, writer)
 
+        # Each output slice blends input slices from z - hf to z + hf, where 
+        # the first and the last block extend to the volume boundary. With 
+        # overlap, the last slice of a block is the first of the next block.
+        def block(j):
+            first = 0 if j == 0 else Z[j] - hf
+            end = len(slicer) if j == len(Z) - 1 else Z[j] + hf + 1
+            return first, end
+
+        def input_slices():
+            # Consecutive blocks cover consecutive slices, each read once
+            if len(J) == 0:
+                return
+            for i in range(block(J[0])[0], block(J[-1])[1]):
+                yield slice if i == 0 else read(i)
+
+        def blend(slices):
+            # Preallocating arrays for 2D blending
+            temp_array = np.zeros((slicer.imshape[0], len(X)), dtype=float)
+            out_array = np.zeros((len(Y), len(X)), dtype=float)   
+            last = (None, None)  # index and value of the last used slice
+            for j in J:
+                first, end = block(j)
+                for i in range(first, end):
+                    this = last[1] if last[0] == i else next(slices)
+                    with progress.stage('resample'):
+                        if i == first:
+                            this_slice = z_weights[i] * this.astype(float)
+                        else:
+                            this_slice += z_weights[i] * this.astype(float)
+                last = (end - 1, this)
+                with progress.stage('resample'):
+                    resample(this_slice, temp_array, out_array)
+                with progress.stage('encode'):
+                    out = out_array.astype(intype)
+                yield finish(out)
+
+        outputs = blend(read_ahead(input_slices(), args.readahead))
+
+    writing = WriteBehind(write, args.readahead)
+    try:
+        for out in outputs:
+            writing.put(out)
+    finally:
+        writing.close()
 
     writer.close()    
-    print('Done!')    
+    if args.resume:
+        checkpoint.remove()
+    print('\nDone!')
+    report = progress.report()
+    print_report(report)
+    if args.report:
+        report.update(source=args.source, destination=args.destination,
+                      factor=args.factor, blend=args.blend, 
+                      slicer=type(slicer).__name__)
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=1)
+
+
+def merge():
+    """
+    Merges the parts written by `tiffify --shard i/N` into one tif file. Strips
+    are copied as they are, without decoding and encoding. Parts which are
+    not finished (with a checkpoint left by `--resume`, or with fewer slices 
+    than their share of the volume) are not merged.
+
+    Positional arguments:
+    - destination: The destination filename, as given to tiffify.
+    - shards: The number of shards N.
+
+    Flags:
+    - keep: If set, part files are kept, otherwise they are removed.
+    - overwrite: If set, allows overwriting. Use with care.
+    """
+    parser = argparse.ArgumentParser(description='Merge tiffify shards.')
+    parser.add_argument('destination')
+    parser.add_argument('shards', type=int)
+    parser.add_argument('--keep', action='store_true', default=False)
+    parser.add_argument('--overwrite', action='store_true', default=False)
+    args = parser.parse_args()
+
+    import numpy as np
+    import tifffile
+    import slicers
+
+    if (not args.overwrite) and os.path.exists(args.destination):
+        print('Destination already exists. Aborting')
+        return
+    parts = [part_filename(args.destination, i, args.shards) 
+             for i in range(args.shards)]
+    missing = [part for part in parts if not os.path.exists(part)]
+    if missing:
+        print(f'Missing parts {", ".join(missing)}. Aborting')
+        return
+    unfinished = [part for part in parts if os.path.exists(part + '.checkpoint')]
+    if unfinished:
+        print(f'Parts {", ".join(unfinished)} have checkpoints, so they are '
+              'not finished. Aborting')
+        return
+
+    # Parts of a finished job have the sizes given by np.array_split
+    counts = []
+    for part in parts:
+        if os.path.getsize(part) <= 16:  # only header, empty shard
+            counts.append(0)
+            continue
+        with tifffile.TiffFile(part) as tif:
+            counts.append(len(tif.pages))
+    expected = [len(j) for j in np.array_split(range(sum(counts)), args.shards)]
+    if counts != expected:
+        print(f'Parts have {counts} slices, expected {expected} for a volume '
+              f'of {sum(counts)} slices, so some parts are incomplete. Aborting')
+        return
+
+    print(f'Merging {args.shards} parts... ', end='', flush=True)
+    bigtiff = sum(os.path.getsize(part) for part in parts) > BIGTIFF_SIZE
+    with tifffile.TiffWriter(args.destination, bigtiff=bigtiff) as writer:
+        for part, count in zip(parts, counts):
+            if count == 0:
+                continue
+            with tifffile.TiffFile(part) as tif:
+                for page in tif.pages:
+                    writer.write(iter(slicers.read_tiff_strips(page)), 
+                                 shape=page.shape, dtype=page.dtype,
+                                 rowsperstrip=page.rowsperstrip,
+                                 compression=page.compression)
+    if not args.keep:
+        for part in parts:
+            os.remove(part)
+    print('Done!')
+
+
 if __name__ == '__main__':
     
     main()
@@ -7,6 +7,11 @@ or (assuming text file with the link exists)
 vis3d file_containing_path.txt
 or simply run
 vis3d and point to a supported file or folder.
+Several volumes (e.g. raw and denoised) are shown side by side, with linked 
+slice and zoom, when given as
+vis3d path_to_volume path_to_other_volume
+A label volume (e.g. a segmentation) is shown in colours over the volume with
+vis3d path_to_volume --labels path_to_label_volume
 
 Currently supported:
 - folder with images
@@ -14,7 +19,13 @@ Currently supported:
 - url to .tif* file
 - .vgi and corresponding vol file
 - .txm file
+- .npy file
+- .raw file with .json sidecar giving shape, dtype and offset
+- .nrrd file with raw encoding
+- .nii and .nii.gz file
 - .txt file containing a url or file/folder path
+- .stitch file combining volumes along z (and with y/x offsets)
+- url of a slice server, see slice_server.py
 
 TODO Figure out setup such that vis3D and tiffify can be installed 
     independently. And such that both can be used from .py and from CL.
@@ -24,61 +35,86 @@ TODO Functionality for changing vmin and vmax
 TODO When pressing 'I', show detailed info about the volume
 
 TODO add support for: 
-- panning the zoom-in window 
 - dcm images (via pydicom?)
-- .nii.gz file (via nibabel?)
-- npy file containing 3d numpy array
-- nrrd file (nearly raw), as in 2022_QIM_54_Butterflies
+- compressed nrrd file (nearly raw), as in 2022_QIM_54_Butterflies
 - changing the file/slicer (via chose_file)
 - chaning the intensity range (maybe a slice-wise range between 
     10 and 90 percentile)
 """
 
-import sys 
+import os
+import argparse
+import time
+import functools
+import collections
+import hashlib
+import concurrent.futures
 import PyQt5.QtCore  
 import PyQt5.QtWidgets 
 import PyQt5.QtGui
 import numpy as np
 import slicers
+import reslice
+import catalog
 
   
 class Vis3d(PyQt5.QtWidgets.QWidget):
+
+    # emitted from background thread when full slice is read
+    sliceLoaded = PyQt5.QtCore.pyqtSignal(int, object, float)
+    # emitted from background thread when preview of slice is read
+    previewLoaded = PyQt5.QtCore.pyqtSignal(int, object)
+    # emitted from background thread when reading slice failed
+    readFailed = PyQt5.QtCore.pyqtSignal(int, object)
+    # emitted from background thread when slices were added to the volume
+    slicesAdded = PyQt5.QtCore.pyqtSignal()
+    # emitted when user changes slice or zoom, with z and source rectangle
+    viewChanged = PyQt5.QtCore.pyqtSignal(int, object)
     
-    def __init__(self, slicer):
+    def __init__(self, slicer, reader=None, labels=None):
+        ''' If reader (a slicers.SharedReader) is given, slices are read 
+        through it, with neighbouring slices prefetched. If labels (a slicer,
+        preferably slicers.RunLengthSlicer) is given, it is shown over the 
+        volume, with a colour for each label.'''
         
         super().__init__() 
         
         self.slicer = slicer
+        self.reader = reader
         self.z = len(slicer)//2
+        self.timings = slicers.Timings()  # conversion and paint times
+        self.showTimings = False
             
         # Pixmap layers and atributes
-        self.format = PyQt5.QtGui.QImage.Format_Grayscale8
-        self.to_format = slicer.to_uint8()
-        if slicer.dtype == np.uint16:
-            print('went into if')
-            try:  # instead, I could check which version is installed
-                self.format = PyQt5.QtGui.QImage.Format_Grayscale16
-                self.to_format = slicers.Slicer.identity  # keep uint16
-            except:
-                print('Grayscale16 introduced in Qt 5.13, you have {PyQt5.QtCore.QT_VERSION_STR}')
-        self.updateImagePix()
-        self.zoomPix = PyQt5.QtGui.QPixmap(self.imagePix.width(), self.imagePix.height()) 
-        self.zoomPix.fill(self.transparentColor)
+        self.imageRect = PyQt5.QtCore.QRect(0, 0, self.slicer.imshape[1], 
+                                            self.slicer.imshape[0])
+        self.tiles = TileCache()
+        self.setLabels(labels)
+        self.setFormat()
+        self.executor = None
+        self.sliceLoaded.connect(self.onSliceLoaded)
+        self.previewLoaded.connect(self.onPreviewLoaded)
+        self.readFailed.connect(self.onReadFailed)
+        self.loadedZ = None  # slice shown in full
+        self.setupProgressive()
+        if not self.tiled:
+            self.updateImagePix()
+        self.updateLabelPix()
         
         # Atributes relating to the transformation between widget 
         # coordinate system and image coordinate system
         self.zoomFactor = 1 # accounts for resizing of the widget and for zooming in the part of the image
         self.padding = PyQt5.QtCore.QPoint(0, 0) # padding when aspect ratio of image and widget does not match
         self.target = PyQt5.QtCore.QRect(0, 0, self.width(), self.height()) # part of the target being drawn on
-        self.source = PyQt5.QtCore.QRect(0, 0, 
-                self.imagePix.width(), self.imagePix.height()) # part of the image being drawn
+        self.source = PyQt5.QtCore.QRect(self.imageRect) # part of the image being drawn
         self.offset = PyQt5.QtCore.QPoint(0, 0) # offset between image center and area of interest center
         
         # Atributes relating to zooming
         self.activelyZooming = False
         self.newZoomValues = None
         self.clickedPoint = PyQt5.QtCore.QPoint()
-        self.zoomPainter = None
+        self.zoomRect = None  # rectangle being dragged, in widget coordinates
+        self.panning = False
         
         # Label for displaying text overlay
         self.textField = PyQt5.QtWidgets.QLabel(self)
@@ -88,18 +124,54 @@ class Vis3d(PyQt5.QtWidgets.QWidget):
         self.textField.move(10, 10)     
         self.hPressed = False
         self.textField.setAttribute(PyQt5.QtCore.Qt.WA_TransparentForMouseEvents)
+
+        # Label for displaying timings overlay
+        self.timingField = PyQt5.QtWidgets.QLabel(self)
+        self.timingField.setStyleSheet("background-color: rgba(191, 191, 191, 191)")
+        self.timingField.setTextFormat(PyQt5.QtCore.Qt.RichText)
+        self.timingField.setAttribute(PyQt5.QtCore.Qt.WA_TransparentForMouseEvents)
+        self.timingField.hide()
         
         # Timer for displaying text overlay
         self.timer = PyQt5.QtCore.QTimer()
         self.timer.setSingleShot(True)
         self.timer.timeout.connect(self.hideText)
 
+        # Timer for checking for new slices, e.g. during a scan. Checking may
+        # be slow (e.g. a request to a slice server), so it is done in 
+        # background using a separate slicer, if the volume may grow
+        self.following = False
+        self.refreshSlicer = None
+        if type(slicer).refresh is not slicers.Slicer.refresh:
+            self.refreshSlicer = slicer.reopen()
+        if self.refreshSlicer is slicer:  # not separate, checked directly
+            self.refreshSlicer = None
+        self.refreshExecutor = None
+        if self.refreshSlicer is not None:
+            self.refreshExecutor = concurrent.futures.ThreadPoolExecutor(1)
+        self.refreshFuture = None
+        self.slicesAdded.connect(self.extendSlices)
+        self.refreshTimer = PyQt5.QtCore.QTimer()
+        self.refreshTimer.timeout.connect(self.refreshSlices)
+        self.refreshTimer.start(1000)
+
+        # Profile of zoomed rectangle through z, computed in background
+        self.profiling = False
+        self.profile = None  # slicers.RoiProfile
+        self.profilePlot = ProfilePlot(self)
+        self.profilePlot.hide()
+        self.profileTimer = PyQt5.QtCore.QTimer()  # redraws while computing
+        self.profileTimer.timeout.connect(self.updateProfile)
+        self.profileDelay = PyQt5.QtCore.QTimer()  # waits for zoom to settle
+        self.profileDelay.setSingleShot(True)
+        self.profileDelay.timeout.connect(self.computeProfile)
+
         # Playtime
         self.setTitle()
-        initial_zoom = min(2000/max(self.imagePix.width(), 
-                4*self.imagePix.height()/3), 1) # downsize if larger than (2000,1500)
-        self.resize(int(initial_zoom*self.imagePix.width()), 
-                    int(initial_zoom*self.imagePix.height()))
+        initial_zoom = min(2000/max(self.imageRect.width(), 
+                4*self.imageRect.height()/3), 1) # downsize if larger than (2000,1500)
+        self.resize(int(initial_zoom*self.imageRect.width()), 
+                    int(initial_zoom*self.imageRect.height()))
         self.showInfo('<i>Starting vis3d</i> <br> For help, hit <b>H</b>', 5000)
         print("Starting vis3d. For help, hit 'H'.")
 
@@ -111,8 +183,17 @@ class Vis3d(PyQt5.QtWidgets.QWidget):
             '<b>KEYBOARD COMMANDS:</b> <br>' 
             '&nbsp; &nbsp; <b>H</b> shows this help <br>' 
             '&nbsp; &nbsp; <b>Arrow keys</b> change slice <br>' 
-            '<b>MOUSE DRAG:</b> <br>' 
-            '&nbsp; &nbsp; Zooms <br><br>'
+            '&nbsp; &nbsp; <b>T</b> toggles timings <br>' 
+            '&nbsp; &nbsp; <b>L</b> saves timings log <br>' 
+            '&nbsp; &nbsp; <b>O</b> toggles oblique slicing <br>' 
+            '&nbsp; &nbsp; <b>W</b>, <b>S</b>, <b>A</b>, <b>D</b> tilt oblique plane <br>' 
+            '&nbsp; &nbsp; <b>F</b> toggles following the newest slice <br>' 
+            '&nbsp; &nbsp; <b>M</b> toggles labels <br>' 
+            '&nbsp; &nbsp; <b>P</b> toggles profile of zoomed rectangle through z <br>' 
+            '<b>MOUSE:</b> <br>' 
+            '&nbsp; &nbsp; Left drag zooms to rectangle <br>'
+            '&nbsp; &nbsp; Right drag pans <br>'
+            '&nbsp; &nbsp; Wheel zooms in and out <br><br>'
             '<i>Volume and vis information</i> <br>'
             f'<b>Vol size:</b> {len(self.slicer)} x {self.slicer.imshape}<br>' 
             f'<b>Vol dtype:</b> {self.slicer.dtype}<br>' 
@@ -125,18 +206,425 @@ class Vis3d(PyQt5.QtWidgets.QWidget):
     # constants
     transparentColor = PyQt5.QtGui.QColor(0, 0, 0, 0)    
     zoomColor = PyQt5.QtGui.QColor(0, 0, 0, 128) 
+    tileSize = 256  # in pixels of the (subsampled) tile
+    tiledSize = 2048  # slices larger than this are shown using tiles
+    labelAlpha = 0.5  # opacity of labels
     
 
+    def setFormat(self):
+        self.format = PyQt5.QtGui.QImage.Format_Grayscale8
+        self.to_format = self.slicer.to_uint8()
+        if self.slicer.dtype == np.uint16:
+            try:  # instead, I could check which version is installed
+                self.format = PyQt5.QtGui.QImage.Format_Grayscale16
+                self.to_format = slicers.Slicer.identity  # keep uint16
+            except:
+                print('Grayscale16 introduced in Qt 5.13, you have {PyQt5.QtCore.QT_VERSION_STR}')
+
     def updateImagePix(self):  
-        '''Transforms np image to Qt Pixmap (via Qt Image)'''
+        '''Reads the slice and shows it.'''
+        t0 = time.perf_counter()
         gray = self.slicer[self.z]
+        self.setImagePix(gray, time.perf_counter() - t0)
+
+    def setImagePix(self, gray, sliceTime):
+        '''Transforms np image to Qt Pixmap (via Qt Image)'''
+        t1 = time.perf_counter()
         gray = self.to_format(gray)
+        t2 = time.perf_counter()
+        self.imagePix = self.toPixmap(gray)
+        self.loadedZ = self.z
+        t3 = time.perf_counter()
+        self.timings.add('update', self.z, slice=sliceTime, convert=t2 - t1, 
+                         pixmap=t3 - t2)
+        if self.showTimings:
+            self.updateTimingField()
+
+    def toPixmap(self, gray):
+        gray = np.ascontiguousarray(gray)
         bytesPerLine = gray.nbytes//gray.shape[0]
         qimage = PyQt5.QtGui.QImage(gray.data, 
                                     gray.shape[1], gray.shape[0],
                                     bytesPerLine, self.format)
-        self.imagePix= PyQt5.QtGui.QPixmap(qimage)
+        return PyQt5.QtGui.QPixmap(qimage)
+
+    def setLabels(self, labels):
+        ''' Sets label volume and colour table. Label 0 is transparent, other
+        labels cycle through 255 colours.'''
+        if labels is not None and (len(labels) != len(self.slicer) or 
+                tuple(labels.imshape) != tuple(self.slicer.imshape)):
+            raise Exception(f'Labels of size {len(labels)} x {labels.imshape} '
+                f'do not match volume of size {len(self.slicer)} x {self.slicer.imshape}.')
+        self.labels = labels
+        self.showLabels = labels is not None
+        self.labelPix = None
+        self.labelTable = [0] + [PyQt5.QtGui.QColor.fromHsvF((0.618034*i)%1, 
+                0.9, 1, self.labelAlpha).rgba() for i in range(255)]
+
+    def updateLabelPix(self):
+        ''' Makes pixmap with labels of slice z, which is painted over the 
+        image. Runs are mapped to colour indices before decoding, such that 
+        the slice is decoded directly into an 8-bit indexed image.'''
+        self.labelPix = None
+        if (not self.showLabels or 
+                isinstance(self.slicer, reslice.ObliqueSlicer) or
+                self.z >= len(self.labels)):
+            return
+        t0 = time.perf_counter()
+        if isinstance(self.labels, slicers.RunLengthSlicer):
+            values, lengths = self.labels.runs(self.z)
+        else:
+            values = self.labels[self.z].ravel()
+            lengths = 1
+        values = values.astype(np.int64)
+        index = np.where(values > 0, (values - 1) % 255 + 1, 0).astype(np.uint8)
+        index = np.repeat(index, lengths).reshape(self.labels.imshape)
+        qimage = PyQt5.QtGui.QImage(index.data, index.shape[1], index.shape[0],
+                index.shape[1], PyQt5.QtGui.QImage.Format_Indexed8)
+        qimage.setColorTable(self.labelTable)
+        self.labelPix = PyQt5.QtGui.QPixmap(qimage)
+        self.timings.add('labels', self.z, labels=time.perf_counter() - t0)
+
+    def toggleLabels(self):
+        if self.labels is None:
+            self.showInfo('No labels given')
+            return
+        self.showLabels = not self.showLabels
+        self.showInfo('Showing labels' if self.showLabels else 'Hiding labels')
+        self.updateLabelPix()
+        self.update()
+
+    def setupProgressive(self):
+        ''' For large slices and slicers which read strided rows cheaply, a 
+        slice change first shows a subsampled preview, while the full slice 
+        is read, both in background using a separate slicer. For very large 
+        slices, only tiles in view are read (see updateTiles), if conversion 
+        to the displayed format does not depend on the whole slice.'''
+        self.previewFactor = int(np.ceil(max(self.slicer.imshape)/512))
+        self.backgroundSlicer = None
+        self.loadedZ = None  # slicer may have changed
+        self.tiles.clear()  # conversion may have changed
+        # oblique slices change with rotation, so they are not shared
+        self.shared = (self.reader is not None and 
+                       not isinstance(self.slicer, reslice.ObliqueSlicer))
+        self.tiled = (self.slicer.partial_reads and not self.shared
+                      and max(self.slicer.imshape) > self.tiledSize
+                      and self.to_format is not slicers.Slicer.slicewise)
+        if self.tiled:
+            return
+        if self.slicer.strided_reads and self.previewFactor > 1:
+            self.backgroundSlicer = self.slicer.reopen()
+        if self.backgroundSlicer is not None and self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(1)
+
+    def changeSlice(self):
+        ''' Shows slice z, progressively if possible.'''
+        if self.tiled:
+            pass  # tiles are read when painting
+        elif self.shared:
+            self.readShared()
+        elif self.backgroundSlicer is None:
+            self.updateImagePix()
+        else:
+            self.executor.submit(self.readInBackground, self.z)
+        self.updateLabelPix()
+        self.profilePlot.z = self.z
+        self.profilePlot.update()
+        self.update()
+        self.viewChanged.emit(self.z, PyQt5.QtCore.QRect(self.source))
+
+    def readShared(self):
+        ''' Shows slice from shared reader, or a preview until it is read.'''
+        t0 = time.perf_counter()
+        z = self.z
+        gray = self.reader.cached(self.slicer, z)
+        if gray is not None:
+            self.setImagePix(gray, time.perf_counter() - t0)
+        else:
+            if self.backgroundSlicer is not None:
+                self.executor.submit(self.readPreview, z)
+            future = self.reader.request(self.slicer, z)
+            future.add_done_callback(lambda f: self.onSharedRead(f, z, t0))
+        self.reader.prefetch(self.slicer, z)
+
+    def onSharedRead(self, future, z, t0):
+        ''' Called from reader thread when slice z is read.'''
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            self.readFailed.emit(z, future.exception())
+        else:
+            self.sliceLoaded.emit(z, future.result(), time.perf_counter() - t0)
+
+    def setView(self, z, source):
+        ''' Shows slice z and source rectangle, e.g. as linked view.'''
+        if source != self.source:
+            self.setSource(source)
+        z = min(max(z, 0), len(self.slicer) - 1)
+        if z != self.z:
+            self.z = z
+            self.changeSlice()
+            self.setTitle()
+
+    def toggleOblique(self):
+        ''' Switches between volume slices and oblique planes.'''
+        if isinstance(self.slicer, reslice.ObliqueSlicer):
+            self.slicer = self.slicer.slicer
+            self.showInfo('Volume slices')
+        else:
+            self.slicer = reslice.ObliqueSlicer(self.slicer)
+            self.showInfo('Oblique slices, tilt with <b>W</b>, <b>S</b>, <b>A</b>, <b>D</b>')
+        if self.showTimings and self.slicer.timings is None:
+            self.slicer.enable_timings()
+        self.setFormat()
+        self.setupProgressive()
+        if self.tiled:
+            self.imagePix = None
+        self.changeSlice()
+        self.restartProfile()
+
+    def tiltOblique(self, axis, angle):
+        if isinstance(self.slicer, reslice.ObliqueSlicer):
+            self.slicer.rotate(axis, angle)
+            self.changeSlice()
+            self.restartProfile()
+
+    def tileLevel(self):
+        ''' Subsampling of tiles, the largest power of 2 not exceeding the 
+        number of image pixels per screen pixel.'''
+        return 2**max(0, int(np.floor(np.log2(1/self.zoomFactor))))
+
+    def visibleTiles(self, level):
+        ''' Rows and columns of tiles covering the source rectangle.'''
+        size = self.tileSize * level  # in image pixels
+        rows = range(self.source.top()//size, self.source.bottom()//size + 1)
+        cols = range(self.source.left()//size, self.source.right()//size + 1)
+        return rows, cols
+
+    def updateTiles(self):
+        ''' Reads and converts tiles which came into view and are not cached.
+        Missing tiles in a row are read with one subslice, as many formats 
+        store whole rows together.'''
+        t0 = time.perf_counter()
+        level = self.tileLevel()
+        size = self.tileSize * level
+        h, w = self.slicer.imshape
+        rows, cols = self.visibleTiles(level)
+        read = reused = 0
+        for ty in rows:
+            missing = [tx for tx in cols 
+                       if (self.z, level, ty, tx) not in self.tiles]
+            if not missing:
+                continue
+            Y = range(ty * size, min((ty + 1) * size, h), level)
+            X = range(missing[0] * size, min((missing[-1] + 1) * size, w), level)
+            band = self.slicer.subslice(self.z, Y, X)
+            for tx in missing:
+                first = (tx - missing[0]) * self.tileSize
+                tile = band[:, first : first + self.tileSize]
+                reused += self.tiles.put((self.z, level, ty, tx), tile, 
+                                         self.toTilePixmap)
+                read += 1
+        if read:
+            self.timings.add('tiles', self.z, slice=time.perf_counter() - t0,
+                             read=read, reused=reused)
+            if self.showTimings:  # after painting, as it repaints
+                PyQt5.QtCore.QTimer.singleShot(0, self.updateTimingField)
+
+    def toTilePixmap(self, tile):
+        return self.toPixmap(self.to_format(tile))
+
+    def paintTiles(self, painter):
+        ''' Paints cached tiles in view, using image coordinates.'''
+        self.updateTiles()
+        level = self.tileLevel()
+        size = self.tileSize * level
+        painter.setClipRect(self.target)
+        painter.translate(self.target.topLeft())
+        painter.scale(self.zoomFactor, self.zoomFactor)
+        painter.translate(-self.source.topLeft())
+        painter.setRenderHint(PyQt5.QtGui.QPainter.SmoothPixmapTransform, 
+                              level > 1)
+        rows, cols = self.visibleTiles(level)
+        for ty in rows:
+            for tx in cols:
+                pixmap = self.tiles.get((self.z, level, ty, tx))
+                if pixmap is not None:
+                    painter.drawPixmap(PyQt5.QtCore.QRectF(tx * size, ty * size,
+                            pixmap.width() * level, pixmap.height() * level),
+                            pixmap, PyQt5.QtCore.QRectF(pixmap.rect()))
+        painter.resetTransform()
+        painter.setClipping(False)
+
+    def refreshSlices(self):
+        ''' Checks for new slices, in background if possible.'''
+        if self.refreshSlicer is None:
+            self.extendSlices()
+        elif self.refreshFuture is None or self.refreshFuture.done():
+            self.refreshFuture = self.refreshExecutor.submit(self.checkSlices)
+
+    def checkSlices(self):
+        if self.refreshSlicer.refresh() > 0:
+            self.slicesAdded.emit()
+
+    def extendSlices(self):
+        ''' Extends the volume with new slices, if any, and shows the newest
+        slice when following.'''
+        if self.slicer.refresh() == 0:
+            return
+        self.restartProfile()
+        if self.following:
+            self.z = len(self.slicer) - 1
+            self.changeSlice()
+        self.setTitle()
+
+    def toggleFollow(self):
+        self.following = not self.following
+        if self.following:
+            self.showInfo('Following the newest slice')
+            self.z = len(self.slicer) - 1
+            self.changeSlice()
+        else:
+            self.showInfo('Not following the newest slice')
+
+    def toggleProfile(self):
+        ''' Shows or hides the profile of the zoomed rectangle through z.'''
+        self.profiling = not self.profiling
+        if self.profiling:
+            self.showInfo('Computing profile of ' + self.formatQRect(self.source))
+            self.restartProfile()
+        else:
+            self.cancelProfile()
+            self.profilePlot.hide()
+
+    def restartProfile(self):
+        ''' Cancels the profile, and computes a new one when the rectangle 
+        stops changing.'''
+        if self.profiling:
+            self.cancelProfile()
+            self.profileDelay.start(300)
+
+    def cancelProfile(self):
+        self.profileDelay.stop()
+        self.profileTimer.stop()
+        if self.profile is not None:
+            self.profile.cancel()
+            self.profile = None
+
+    def computeProfile(self):
+        roi = self.source.intersected(self.imageRect)
+        self.profile = slicers.RoiProfile(self.slicer, 
+                range(roi.top(), roi.bottom() + 1),
+                range(roi.left(), roi.right() + 1), self.z)
+        self.profilePlot.z = self.z
+        self.profilePlot.setProfile(self.profile, self.formatQRect(roi))
+        self.profilePlot.show()
+        self.moveProfilePlot()
+        self.profileTimer.start(100)
+
+    def updateProfile(self):
+        if self.profile is None:
+            return
+        if self.profile.finished():
+            self.profileTimer.stop()
+            if self.profile.error is not None:
+                self.showInfo(f'Profile failed: {self.profile.error}')
+        self.profilePlot.update()
+
+    def moveProfilePlot(self):
+        self.profilePlot.move(self.width() - self.profilePlot.width() - 10,
+                              self.height() - self.profilePlot.height() - 10)
+
+    def readPreview(self, z):
+        if z != self.z:  # slice changed again while waiting
+            return
+        h, w = self.slicer.imshape
+        f = self.previewFactor
+        gray = self.backgroundSlicer.subslice(z, range(0, h, f), range(0, w, f))
+        self.previewLoaded.emit(z, gray)
+
+    def onPreviewLoaded(self, z, gray):
+        if z == self.z and self.loadedZ != z:
+            h, w = self.slicer.imshape
+            # scaled to full size, such that zoom rectangles remain valid
+            self.imagePix = self.toPixmap(self.to_format(gray)).scaled(w, h)
+            self.update()
+
+    def readInBackground(self, z):
+        try:
+            self.readPreview(z)
+            if z != self.z:
+                return
+            t0 = time.perf_counter()
+            gray = self.backgroundSlicer[z]
+        except Exception as e:
+            self.readFailed.emit(z, e)
+            return
+        self.sliceLoaded.emit(z, gray, time.perf_counter() - t0)
+
+    def onSliceLoaded(self, z, gray, sliceTime):
+        if z == self.z and (self.backgroundSlicer is not None or self.shared):
+            self.setImagePix(gray, sliceTime)
+            self.update()
             
+    def onReadFailed(self, z, error):
+        if z == self.z:
+            self.showInfo(f'Reading slice {z} failed: {error}', 5000)
+
+    def toggleTimings(self):
+        ''' Shows or hides timings overlay, recording slicer timings while shown.'''
+        self.showTimings = not self.showTimings
+        if self.showTimings:
+            if self.slicer.timings is None:
+                self.slicer.enable_timings()
+            self.updateTimingField()
+            self.timingField.show()
+        else:
+            self.timingField.hide()
+        self.update()
+
+    def updateTimingField(self):
+        ms = lambda seconds: f'{1000*seconds:.1f} ms'
+        text = '<i>Timings of last slice</i> <br>'
+        read = self.slicer.timings.last() if self.slicer.timings else None
+        if read is not None:
+            text += (f'<b>Read:</b> {ms(read["read"])}<br>'
+                     f'<b>Decode:</b> {ms(read["decode"])}<br>'
+                     f'<b>Bytes read:</b> {read["nbytes"]/2**20:.2f} MB<br>')
+        tiles = self.timings.last('tiles')
+        if self.tiled and tiles is not None:
+            text += (f'<b>Tiles total:</b> {ms(tiles["slice"])}<br>'
+                     f'<b>Tiles read:</b> {tiles["read"]} '
+                     f'({tiles["reused"]} reused)<br>')
+        update = self.timings.last('update')
+        if update is not None and not self.tiled:
+            text += (f'<b>Slice total:</b> {ms(update["slice"])}<br>'
+                     f'<b>Conversion:</b> {ms(update["convert"])}<br>'
+                     f'<b>Pixmap:</b> {ms(update["pixmap"])}<br>')
+        labels = self.timings.last('labels')
+        if labels is not None and self.labelPix is not None:
+            text += f'<b>Labels:</b> {ms(labels["labels"])}<br>'
+        paint = self.timings.last('paint')
+        if paint is not None:
+            text += f'<b>Paint (previous):</b> {ms(paint["paint"])}'
+        self.timingField.setText(text)
+        self.timingField.adjustSize()
+        self.moveTimingField()
+
+    def moveTimingField(self):
+        self.timingField.move(10, self.height() - self.timingField.height() - 10)
+
+    def saveTimings(self, filename=None):
+        ''' Saves vis3d and slicer timings of this session as json.'''
+        if filename is None:
+            filename = time.strftime('vis3d_timings_%Y%m%d_%H%M%S.json')
+        timings = slicers.Timings()
+        timings.records = self.timings.records + (self.slicer.timings.records
+                if self.slicer.timings else [])
+        timings.save(filename, volume=str(self.slicer.filename),
+                     slicer=type(self.slicer).__name__)
+        self.showInfo(f'Saved timings to {filename}')
+
     def showHelp(self):
         self.timer.stop()
         self.showText(self.helpText)
@@ -158,43 +646,47 @@ class Vis3d(PyQt5.QtWidgets.QWidget):
     def setTitle(self):
         self.setWindowTitle(f'z={self.z}/{len(self.slicer)}')
         
-    def makeZoomPainter(self):
-        painter_scribble = PyQt5.QtGui.QPainter(self.zoomPix)       
-        painter_scribble.translate(-self.offset)
-        painter_scribble.scale(1/self.zoomFactor, 1/self.zoomFactor)
-        painter_scribble.translate(-self.padding)        
-        painter_scribble.setCompositionMode(
-                    PyQt5.QtGui.QPainter.CompositionMode_Source)
-        return painter_scribble
-    
     def paintEvent(self, event):
         """ Paint event for displaying the content of the widget."""
+        t0 = time.perf_counter()
         painter_display = PyQt5.QtGui.QPainter(self) # this is painter used for display
         painter_display.setCompositionMode(
                     PyQt5.QtGui.QPainter.CompositionMode_SourceOver)
-        painter_display.drawPixmap(self.target, self.imagePix, self.source)
-        if self.activelyZooming:
-            painter_display.drawPixmap(self.target, self.zoomPix, self.source)
+        if self.tiled:
+            self.paintTiles(painter_display)
+        else:
+            painter_display.drawPixmap(self.target, self.imagePix, self.source)
+        if self.labelPix is not None:
+            painter_display.drawPixmap(self.target, self.labelPix, self.source)
+        if self.activelyZooming and self.zoomRect is not None:
+            painter_display.fillRect(self.zoomRect, self.zoomColor)
+        painter_display.end()
+        # timing field is updated with the slice, updating it here would repaint
+        self.timings.add('paint', self.z, paint=time.perf_counter() - t0)
             
     def mousePressEvent(self, event):
         if event.button() == PyQt5.QtCore.Qt.LeftButton: 
             self.activelyZooming = True
             self.clickedPoint = event.pos()
-            self.zoomPix.fill(self.transparentColor) # clear (fill with transparent)
-            self.zoomPainter = self.makeZoomPainter()          
+            self.zoomRect = None
             self.update()
+        elif event.button() == PyQt5.QtCore.Qt.RightButton:
+            self.panning = True
+            self.clickedPoint = event.pos()
     
     def mouseMoveEvent(self, event):
         if self.activelyZooming: 
-            self.zoomPix.fill(self.transparentColor) # clear (fill with transparent)
-            x = min(self.clickedPoint.x(), event.x())
-            y = min(self.clickedPoint.y(), event.y())
-            w = abs(self.clickedPoint.x() - event.x())
-            h = abs(self.clickedPoint.y() - event.y())
-            self.zoomPainter.fillRect(x, y, w, h, self.zoomColor)       
+            self.zoomRect = PyQt5.QtCore.QRect(self.clickedPoint, 
+                                               event.pos()).normalized()
             self.update()
+        elif self.panning:
+            self.pan(self.clickedPoint - event.pos())
+            self.clickedPoint = event.pos()
     
     def mouseReleaseEvent(self, event):  
+        if self.panning:
+            self.panning = False
+            return
         x = min(self.clickedPoint.x(), event.x())
         y = min(self.clickedPoint.y(), event.y())
         w = abs(self.clickedPoint.x() - event.x())
@@ -204,13 +696,45 @@ class Vis3d(PyQt5.QtWidgets.QWidget):
             self.executeZoom()
         else: 
             self.resetZoom()
-        self.zoomPainter = None
+        self.zoomRect = None
         self.activelyZooming = False   
         self.update()
+
+    def wheelEvent(self, event):
+        """ Zooms in or out, keeping the point under the cursor in place. """
+        scale = 0.8 if event.angleDelta().y() > 0 else 1.25
+        point = ((event.pos() - self.padding) / self.zoomFactor 
+                 + self.source.topLeft())  # in image coordinates
+        size = self.source.size() * scale
+        if min(size.width(), size.height()) < 2:
+            return
+        topLeft = point - (point - self.source.topLeft()) * scale
+        self.setSource(PyQt5.QtCore.QRect(topLeft, size))
+
+    def pan(self, delta):
+        """ Moves the zoomed part of the image by delta widget pixels. """
+        self.setSource(self.source.translated(delta / self.zoomFactor))
+
+    def setSource(self, source):
+        """ Shows source rectangle, moved and cropped to fit in the image. """
+        source = PyQt5.QtCore.QRect(source.topLeft(), 
+                source.size().boundedTo(self.imageRect.size()))
+        source.moveLeft(min(max(source.left(), 0), 
+                            self.imageRect.width() - source.width()))
+        source.moveTop(min(max(source.top(), 0), 
+                           self.imageRect.height() - source.height()))
+        self.source = source
+        self.offset = self.imageRect.topLeft() - self.source.topLeft()
+        self.adjustTarget()
+        self.update()
+        self.restartProfile()
+        self.viewChanged.emit(self.z, PyQt5.QtCore.QRect(self.source))
             
     def resizeEvent(self, event):
         """ Triggered by resizing of the widget window. """
         self.adjustTarget()
+        self.moveTimingField()
+        self.moveProfilePlot()
                 
     def adjustTarget(self):
         """ Computes padding needed such that aspect ratio of the image is correct. """
@@ -237,47 +761,66 @@ class Vis3d(PyQt5.QtWidgets.QWidget):
         self.source = PyQt5.QtCore.QRect(self.newZoomValues.topLeft()/self.zoomFactor,
                 self.newZoomValues.size()/self.zoomFactor)
         self.source.translate(-self.offset)
-        self.source = self.source.intersected(self.imagePix.rect()) 
+        self.source = self.source.intersected(self.imageRect) 
         self.showInfo('Zooming to ' + self.formatQRect(self.source))     
-        self.offset = self.imagePix.rect().topLeft() - self.source.topLeft()
+        self.offset = self.imageRect.topLeft() - self.source.topLeft()
         self.adjustTarget()
         self.newZoomValues = None
+        self.restartProfile()
+        self.viewChanged.emit(self.z, PyQt5.QtCore.QRect(self.source))
     
     def resetZoom(self):
         """ Back to original zoom """
-        self.source = PyQt5.QtCore.QRect(0, 0, self.imagePix.width(), 
-                                         self.imagePix.height())
+        self.source = PyQt5.QtCore.QRect(self.imageRect)
         self.showInfo('Reseting zoom to ' + self.formatQRect(self.source))        
         self.offset = PyQt5.QtCore.QPoint(0, 0)
         self.adjustTarget()        
         self.newZoomValues = None
+        self.restartProfile()
+        self.viewChanged.emit(self.z, PyQt5.QtCore.QRect(self.source))
             
     def keyPressEvent(self, event):
 
         if event.key()==PyQt5.QtCore.Qt.Key_Up: # uparrow          
             self.z = min(self.z + 1, len(self.slicer)-1)
-            self.updateImagePix()
-            self.update()
+            self.changeSlice()
 
         elif event.key()==PyQt5.QtCore.Qt.Key_Down: # downarrow
             self.z = max(self.z-1, 0)
-            self.updateImagePix()
-            self.update()
+            self.changeSlice()
             
         elif event.key()==PyQt5.QtCore.Qt.Key_Right: 
             self.z = min(self.z+10, len(self.slicer) - 1)
-            self.updateImagePix()
-            self.update()
+            self.changeSlice()
 
         elif event.key()==PyQt5.QtCore.Qt.Key_Left: 
             self.z = max(self.z-10, 0)
-            self.updateImagePix()
-            self.update()
+            self.changeSlice()
 
         elif event.key()==PyQt5.QtCore.Qt.Key_H: # h        
             if not self.hPressed:
                 self.hPressed = True
                 self.showHelp()
+        elif event.key()==PyQt5.QtCore.Qt.Key_T: 
+            self.toggleTimings()
+        elif event.key()==PyQt5.QtCore.Qt.Key_L: 
+            self.saveTimings()
+        elif event.key()==PyQt5.QtCore.Qt.Key_O: 
+            self.toggleOblique()
+        elif event.key()==PyQt5.QtCore.Qt.Key_W: 
+            self.tiltOblique(2, 5)
+        elif event.key()==PyQt5.QtCore.Qt.Key_S: 
+            self.tiltOblique(2, -5)
+        elif event.key()==PyQt5.QtCore.Qt.Key_A: 
+            self.tiltOblique(1, 5)
+        elif event.key()==PyQt5.QtCore.Qt.Key_D: 
+            self.tiltOblique(1, -5)
+        elif event.key()==PyQt5.QtCore.Qt.Key_F: 
+            self.toggleFollow()
+        elif event.key()==PyQt5.QtCore.Qt.Key_M: 
+            self.toggleLabels()
+        elif event.key()==PyQt5.QtCore.Qt.Key_P: 
+            self.toggleProfile()
         elif event.key()==PyQt5.QtCore.Qt.Key_Escape: # escape
             self.closeEvent(event)
         self.setTitle()
@@ -300,6 +843,151 @@ class Vis3d(PyQt5.QtWidgets.QWidget):
         s = f'({coords[0]},{coords[1]})--({coords[2]},{coords[3]})'
         return(s)  
 
+
+class MultiVis3d(PyQt5.QtWidgets.QWidget):
+    ''' Shows several volumes side by side, with linked slice and zoom. All
+    panes read through one SharedReader, with a common memory budget.'''
+
+    def __init__(self, volumes, max_bytes=2**30, labels=None):
+
+        super().__init__()
+        self.reader = slicers.SharedReader(max_bytes)
+        self.linking = False  # avoids linked panes changing each other back
+        layout = PyQt5.QtWidgets.QHBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        self.panes = []
+        for volume in volumes:
+            pane = Vis3d(volume, self.reader, labels)
+            pane.setFocusPolicy(PyQt5.QtCore.Qt.StrongFocus)
+            pane.viewChanged.connect(functools.partial(self.link, pane))
+            layout.addWidget(pane)
+            self.panes.append(pane)
+        self.panes[0].setFocus()
+        self.setTitle(self.panes[0].z)
+        width = sum(pane.width() for pane in self.panes)
+        scale = min(2000/width, 1)
+        self.resize(int(scale * width), 
+                    int(scale * max(pane.height() for pane in self.panes)))
+
+    def link(self, pane, z, source):
+        if self.linking:
+            return
+        self.linking = True
+        try:
+            for other in self.panes:
+                if other is not pane:
+                    other.setView(z, source)
+        finally:
+            self.linking = False
+        self.setTitle(z)
+
+    def setTitle(self, z):
+        self.setWindowTitle(f'z={z}/{len(self.panes[0].slicer)}, ' +
+                ' | '.join(os.path.basename(str(pane.slicer.filename)) 
+                           for pane in self.panes))
+
+
+class ProfilePlot(PyQt5.QtWidgets.QWidget):
+    ''' Plots mean (line) and min to max (band) of a slicers.RoiProfile 
+    against z, with the shown slice marked. Slices not computed yet are 
+    left empty.'''
+
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.setAttribute(PyQt5.QtCore.Qt.WA_TransparentForMouseEvents)
+        self.resize(360, 180)
+        self.profile = None
+        self.title = ''
+        self.z = 0
+
+    background = PyQt5.QtGui.QColor(191, 191, 191, 191)
+    bandColor = PyQt5.QtGui.QColor(70, 130, 180, 128)
+    meanColor = PyQt5.QtGui.QColor(0, 0, 128)
+    zColor = PyQt5.QtGui.QColor(200, 0, 0)
+
+    def setProfile(self, profile, title):
+        self.profile = profile
+        self.title = title
+        self.update()
+
+    def paintEvent(self, event):
+        painter = PyQt5.QtGui.QPainter(self)
+        painter.fillRect(self.rect(), self.background)
+        profile = self.profile
+        if profile is None:
+            return
+        Z = len(profile.mean)
+        painter.drawText(5, 15, f'{self.title}, slices {profile.done}/{Z}')
+        if 0 <= self.z < Z and not np.isnan(profile.mean[self.z]):
+            painter.drawText(5, 30, f'z={self.z}: mean {profile.mean[self.z]:.4g},'
+                    f' min {profile.min[self.z]:.4g}, max {profile.max[self.z]:.4g}')
+        valid = np.flatnonzero(~np.isnan(profile.mean))
+        if len(valid) == 0:
+            return
+        low, high = np.min(profile.min[valid]), np.max(profile.max[valid])
+        left, top, width, height = 5, 38, self.width() - 10, self.height() - 43
+        x = left + width * (valid + 0.5) / Z
+        scale = lambda v: top + height * (high - v) / max(high - low, 1e-12)
+        painter.setPen(self.bandColor)
+        painter.drawLines([PyQt5.QtCore.QLineF(xi, scale(a), xi, scale(b)) for 
+                xi, a, b in zip(x, profile.min[valid], profile.max[valid])])
+        painter.setPen(self.meanColor)
+        painter.drawPolyline(PyQt5.QtGui.QPolygonF([PyQt5.QtCore.QPointF(xi, 
+                scale(m)) for xi, m in zip(x, profile.mean[valid])]))
+        painter.setPen(self.zColor)
+        zx = left + width * (self.z + 0.5) / Z
+        painter.drawLine(PyQt5.QtCore.QLineF(zx, top, zx, top + height))
+
+
+class TileCache:
+    ''' Least recently used cache of tile pixmaps, limited to max_bytes. 
+    Pixmaps are stored by content, so tiles which are equal in nearby slices,
+    or elsewhere (e.g. background), are converted and stored only once.'''
+
+    def __init__(self, max_bytes=2**28, max_keys=2**16):
+        self.max_bytes = max_bytes
+        self.max_keys = max_keys
+        self.clear()
+
+    def clear(self):
+        self._pixmaps = collections.OrderedDict()  # content digest: pixmap
+        self._digests = collections.OrderedDict()  # tile key: content digest
+        self._nbytes = 0
+
+    def __contains__(self, key):
+        return self._digests.get(key) in self._pixmaps
+
+    def get(self, key):
+        digest = self._digests.get(key)
+        if digest not in self._pixmaps:
+            return None
+        self._digests.move_to_end(key)
+        self._pixmaps.move_to_end(digest)
+        return self._pixmaps[digest]
+
+    def put(self, key, tile, to_pixmap):
+        ''' Stores pixmap of tile, converting it only if content is new. 
+        Returns whether an existing pixmap was reused.'''
+        tile = np.ascontiguousarray(tile)
+        digest = hashlib.blake2b(tile.data, digest_size=16)
+        digest.update(repr((tile.shape, tile.dtype.str)).encode())
+        digest = digest.digest()
+        reused = digest in self._pixmaps
+        if reused:
+            self._pixmaps.move_to_end(digest)
+        else:
+            pixmap = to_pixmap(tile)
+            self._pixmaps[digest] = pixmap
+            self._nbytes += pixmap.width() * pixmap.height() * pixmap.depth() // 8
+        self._digests[key] = digest
+        self._digests.move_to_end(key)
+        while self._nbytes > self.max_bytes and len(self._pixmaps) > 1:
+            _, old = self._pixmaps.popitem(last=False)
+            self._nbytes -= old.width() * old.height() * old.depth() // 8
+        while len(self._digests) > self.max_keys:
+            self._digests.popitem(last=False)
+        return reused
+
     
 def chose_file():
     file_dialog = PyQt5.QtWidgets.QFileDialog()
@@ -308,19 +996,66 @@ def chose_file():
     # A text file with history may be placed in
     # pathlib.Path(__file__).resolve()
     
+    # Previews from catalog (see catalog.py) need a non-native dialog
+    file_dialog.setOption(PyQt5.QtWidgets.QFileDialog.DontUseNativeDialog)
+    preview = PyQt5.QtWidgets.QLabel()
+    preview.setFixedWidth(catalog.PREVIEW_SIZE)
+    preview.setAlignment(PyQt5.QtCore.Qt.AlignCenter)
+    preview.setWordWrap(True)
+    file_dialog.layout().addWidget(preview, 0, file_dialog.layout().columnCount(), -1, 1)
+    file_dialog.currentChanged.connect(lambda path: show_catalog_preview(preview, path))
+    
     if file_dialog.exec_(): # file chosen
         volumenames = file_dialog.selectedFiles()
         volumename = volumenames[0]
         return volumename
     # else retuns None
     
+
+def show_catalog_preview(label, path):
+    ''' Shows thumbnail and description from catalog, if path is cataloged.'''
+    entry = catalog.cached_entry(path)
+    if entry is None:
+        label.clear()
+        return
+    text = catalog.describe(entry)
+    if 'previews' in entry:
+        pixmap = PyQt5.QtGui.QPixmap(catalog.catalog_filename(path, '_xy.png'))
+        label.setPixmap(pixmap)
+        label.setToolTip(text)
+    else:
+        label.setText(text)
+
             
+def read_labels(name):
+    ''' Reads label volume once, keeping it run-length encoded.'''
+    print('Reading labels...')
+    labels = slicers.RunLengthSlicer(slicers.slicer(name))
+    print(f'Labels take {labels.runs_nbytes()/2**20:.1f} MB, '
+          f'dense {labels.nbytes()/2**20:.1f} MB.')
+    return labels
+
+
 def main():
+    parser = argparse.ArgumentParser(description='Show volume slices.')
+    parser.add_argument('volumes', nargs='*')
+    parser.add_argument('--labels')
+    args = parser.parse_args()
     app = PyQt5.QtWidgets.QApplication([]) 
+    labels = read_labels(args.labels) if args.labels else None
     
+    # Several volumes given in command line, shown side by side.
+    if len(args.volumes)>1:
+        print('Starting slicers...')
+        window = MultiVis3d([slicers.slicer(name) for name in args.volumes],
+                            labels=labels)
+        window.show()
+        app.exec()
+        return
+
     # Volume name given in command line.
-    if len(sys.argv)>1:
-        volumename = sys.argv[1]
+    if args.volumes:
+        volumename = args.volumes[0]
 
     # System dialog for choosing volume name.
     else:
@@ -329,7 +1064,7 @@ def main():
     if volumename:
         print('Starting slicer...')
         slicer = slicers.slicer(volumename)                
-        vis3d = Vis3d(slicer)
+        vis3d = Vis3d(slicer, labels=labels)
         vis3d.show()
         app.exec() 
         